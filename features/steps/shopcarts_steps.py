@@ -6,6 +6,7 @@ Steps file for shopcarts.feature
 For information on Waiting until elements are present in the HTML see:
     https://selenium-python.readthedocs.io/waits.html
 """
+from os import getenv
 import requests
 from behave import given
 from compare import expect
@@ -15,45 +16,26 @@ import logging
 @given('the following shopcarts')
 def step_impl(context):
     """ Delete all shopcarts and load new ones """
-    # List all of the pets and delete them one by one
+    # replace every shopcart with the table in one request, however
+    # much data the last scenario left behind
     rest_endpoint = f"{context.BASE_URL}/api/shopcarts"
     headers = {"User-Agent": "Mozilla/5.0", "Accept-Language": "en"}
-    context.resp = requests.get(rest_endpoint, headers=headers)
-    expect(context.resp.status_code).to_equal(200)
-    customer_id_set = set()
-    print(rest_endpoint)
-    # delete all shopcarts and products
-    for shopcart in context.resp.json():
-        customer_id = shopcart["id"]
-        if customer_id not in customer_id_set:
-            customer_id_set.add(customer_id)
-            context.resp = requests.put(f"{rest_endpoint}/{customer_id}/clear", json={}, headers=headers)
-            expect(context.resp.status_code).to_equal(200)
-            context.resp = requests.delete(f"{rest_endpoint}/{customer_id}", headers=headers)
-            expect(context.resp.status_code).to_equal(204)
-
-    # load the database with new shopcarts
-    customer_id_set = set()
+    shopcarts = {}
     for row in context.table:
-        customer_id = row["customer_id"]
-        if customer_id not in customer_id_set:
-            customer_id_set.add(customer_id)
-            shopcart_payload = {
-                "id": customer_id,
-                "products": []
-            }
-            context.resp = requests.post(f"{rest_endpoint}/{customer_id}", json=shopcart_payload, headers=headers)
-            expect(context.resp.status_code).to_equal(201)
-        product_payload = {
-            "id": row["id"],
+        customer_id = int(row["customer_id"])
+        shopcart = shopcarts.setdefault(customer_id, {"id": customer_id, "products": []})
+        shopcart["products"].append({
+            "id": int(row["id"]),
             "name": row["name"],
-            "quantity": row["quantity"],
-            "price": row["price"],
-            "shopcart_id": customer_id
-        }
-        context.resp = requests.post(f"{rest_endpoint}/{customer_id}/products", json=product_payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
-    rest_endpoint = f"{context.BASE_URL}/api/shopcarts"
+            "quantity": int(row["quantity"]),
+            "price": float(row["price"]),
+        })
+    context.resp = requests.put(
+        f"{context.BASE_URL}/api/admin/reset",
+        json={"shopcarts": list(shopcarts.values())},
+        headers=dict(headers, **{"X-Admin-Token": getenv("ADMIN_RESET_TOKEN", "")}),
+    )
+    expect(context.resp.status_code).to_equal(200)
     context.resp = requests.get(rest_endpoint)
     for shopcart in context.resp.json():
         logging.info(shopcart)
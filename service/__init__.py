@@ -23,7 +23,7 @@ This module contains the microservice code for
 import sys
 from flask import Flask
 from flask_restx import Api
-from service.utils import log_handlers
+from service.utils import log_handlers, compression, representations
 from service import config
 
 # NOTE: Do not change the order of this code
@@ -35,6 +35,7 @@ app = Flask(__name__)
 app.config.from_object(config)
 
 app.url_map.strict_slashes = False
+compression.init_compression(app)
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -50,6 +51,7 @@ api = Api(
     prefix="/api",
     format_checker=("str")
 )
+representations.init_representations(api)
 
 # Import the routes After the Flask app is created
 from service import routes  # noqa: E402, E261
@@ -16,10 +16,60 @@ if 'VCAP_SERVICES' in os.environ:
     vcap = json.loads(os.environ['VCAP_SERVICES'])
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 
+# Optional read replica that serves the GET endpoints
+DATABASE_REPLICA_URI = os.getenv("DATABASE_REPLICA_URI")
+
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
+SQLALCHEMY_BINDS = {"replica": DATABASE_REPLICA_URI} if DATABASE_REPLICA_URI else None
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_POOL_SIZE = 2
+# an in-memory SQLite database (sqlite://) is one shared connection, for tests only
+SQLALCHEMY_POOL_SIZE = None if DATABASE_URI.startswith("sqlite") else 2
+
+# Seconds a client keeps reading from the primary after its own write
+REPLICA_READ_YOUR_WRITES = int(os.getenv("REPLICA_READ_YOUR_WRITES", "5"))
+
+# Where responses to requests with an Idempotency-Key are kept
+# ("database" or "memory") and for how many seconds
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "database")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+# Largest number of operations accepted by one /api/batch request
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "100"))
+
+# Largest number of shop carts priced by one /api/quotes request
+QUOTE_MAX_CARTS = int(os.getenv("QUOTE_MAX_CARTS", "1000"))
+
+# Products changed per transaction when a product is repriced
+REPRICE_BATCH_SIZE = int(os.getenv("REPRICE_BATCH_SIZE", "10000"))
+
+# Responses smaller than this many bytes are not worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Seconds browsers may cache static assets requested with a content hash
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Longest a /api/events long-poll may wait, and how often it checks
+EVENTS_MAX_WAIT = int(os.getenv("EVENTS_MAX_WAIT", "30"))
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.5"))
+
+# Days the cart events are kept before flask purge-events deletes them
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "7"))
+
+# Notifications a /stream subscriber may fall behind by before it is told
+# to re-read the cart, and the seconds between keep-alive comments
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "100"))
+STREAM_KEEPALIVE = int(os.getenv("STREAM_KEEPALIVE", "15"))
+
+# Allows PUT /api/admin/reset to wipe and reload every cart, for test
+# environments only
+ADMIN_RESET_ENABLED = os.getenv("ADMIN_RESET_ENABLED", "false").lower() in ("true", "1", "yes")
+# When set, resets must also send it in the X-Admin-Token header
+ADMIN_RESET_TOKEN = os.getenv("ADMIN_RESET_TOKEN", "")
+
+# Number of hash partitions for the product table (0 = not partitioned)
+PRODUCT_PARTITIONS = int(os.getenv("PRODUCT_PARTITIONS", "0"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -3,19 +3,88 @@ Models for ShopCart
 
 All of the models are stored in this module
 """
+import json
 import logging
-from flask_sqlalchemy import SQLAlchemy
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import chain
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, event, inspect, and_, bindparam, select, DDL, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from service.utils.broadcast import Broadcaster, NotificationListener
+from service.utils import snapshot
+from service.utils.bulk import chunks, copy_rows
+from service.utils.money import to_cents, from_cents
+from service.utils.trigram import TrigramIndex
 
 logger = logging.getLogger("flask.app")
 
+# Name of the SQLALCHEMY_BINDS entry that points at the read replica
+REPLICA_BIND = "replica"
+
+# Postgres NOTIFY channel that carries the cart change notifications
+CART_CHANGES_CHANNEL = "cart_changes"
+
+# Fans the cart change notifications out to the subscribers of this process
+cart_changes = Broadcaster()
+_cart_changes_listener = None
+_cart_changes_lock = threading.Lock()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends its queries to the read replica when asked to,
+    and that can hold back commits so several requests share a transaction
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Returns the replica engine for read-only sessions, else the primary"""
+        if self.info.get("read_only") and not self._flushing:
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+    def commit(self):
+        """Commits the transaction, or only flushes it while commits are deferred"""
+        if self.info.get("defer_commit"):
+            self.flush()
+            return
+        super().commit()
+
+    def rollback(self):
+        """
+        Rolls back the transaction, or inside a batch operation only back to
+        the savepoint of the operation, which starts over in a new one
+        """
+        savepoint = self.info.get("batch_savepoint")
+        if savepoint is None:
+            super().rollback()
+            return
+        if savepoint.is_active:
+            savepoint.rollback()
+        self.info["batch_savepoint"] = self.begin_nested()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension that creates routing sessions"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
-    pass
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or {}
 
 
 class PersistentBase:
@@ -36,7 +105,7 @@ class PersistentBase:
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        create_tables(app.config.get("PRODUCT_PARTITIONS", 0))  # make our sqlalchemy tables
 
     @classmethod
     def all(cls):
@@ -53,19 +122,179 @@ class Product(db.Model, PersistentBase):
     Class that represents an Product
     """
 
+    # Ways a product name can be matched when searching
+    MATCH_MODES = ("exact", "icase", "prefix", "fuzzy")
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(260), nullable=False)
+    name = db.Column(db.String(260), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price_cents = db.Column(db.BigInteger, nullable=False)
     shopcart_id = db.Column(db.Integer, db.ForeignKey("shopcart.id"), nullable=False)
 
+    # the products of a cart are looked up by (shopcart_id, id), and the
+    # index also serves every query on shopcart_id alone
+    __table_args__ = (db.Index("ix_product_shopcart_id_id", "shopcart_id", "id"),)
+
+    @hybrid_property
+    def price(self):
+        """The price as the decimal amount, it is stored as whole cents"""
+        return from_cents(self.price_cents)
+
+    @price.setter
+    def price(self, amount):
+        self.price_cents = to_cents(amount)
+
+    @price.expression
+    def price(cls):  # pylint: disable=no-self-argument
+        return cls.price_cents / 100.0
+
     @classmethod
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def find_in_cart(cls, shopcart_id, by_id):
+        """Finds a product by it's ID, or None when it is not in the shop cart"""
+        logger.info("Processing lookup for id %s in shopcart %s ...", by_id, shopcart_id)
+        return cls.query.filter(cls.shopcart_id == shopcart_id, cls.id == by_id).first()
+
+    @classmethod
+    def line_rows(cls, shopcart_ids):
+        """
+        Returns the (shopcart_id, id, name, quantity, price_cents) rows of the
+        products in the shop carts, without loading Product objects
+        Args:
+            shopcart_ids (list): the ids of the shop carts
+        """
+        shopcart_ids = list(shopcart_ids)
+        if not shopcart_ids:
+            return []
+        return (
+            db.session.query(cls.shopcart_id, cls.id, cls.name, cls.quantity, cls.price_cents)
+            .filter(cls.shopcart_id.in_(shopcart_ids))
+            .order_by(cls.shopcart_id, cls.id)
+            .all()
+        )
+
+    @classmethod
+    def reprice(cls, price, name=None, ids=None, batch=10000, progress=None):
+        """
+        Sets the price of every product with the name, or with one of the
+        ids, in every shop cart. Each batch of products is changed with one
+        UPDATE and committed with its events, so no transaction grows with
+        the number of carts that hold the product.
+        Args:
+            price (float): the new price
+            name (string): the name of the products to reprice
+            ids (list): the ids of the products to reprice, instead of a name
+            batch (int): the number of products changed per transaction
+            progress (callable): called with the running totals after each batch
+        Returns:
+            a dict with the number of products, shopcarts and batches changed
+        """
+        if (name is None) == (ids is None):
+            raise DataValidationError("Invalid reprice: give either a product name or product ids")
+        try:
+            price_cents = to_cents(price)
+        except ValueError as error:
+            raise DataValidationError("Invalid reprice: " + error.args[0])
+        if price_cents < 0 or batch < 1:
+            raise DataValidationError("Invalid reprice: the price and batch must be positive")
+        logger.info("Repricing %s to %s in batches of %d", name or ids, price, batch)
+        totals = {"products": 0, "shopcarts": 0, "batches": 0}
+        shopcart_ids = set()
+        for rows in cls._reprice_batches(price_cents, name, ids, batch):
+            cls._reprice_batch(rows, price_cents)
+            shopcart_ids.update(row.shopcart_id for row in rows)
+            totals["products"] += len(rows)
+            totals["shopcarts"] = len(shopcart_ids)
+            totals["batches"] += 1
+            if progress:
+                progress(dict(totals))
+        return totals
+
+    @classmethod
+    def _reprice_batches(cls, price_cents, name, ids, batch):
+        """Generates the batches of (id, shopcart_id, name, quantity) rows whose price differs"""
+        columns = (cls.id, cls.shopcart_id, cls.name, cls.quantity)
+        if ids is not None:
+            for chunk in chunks(sorted(set(ids)), batch):
+                rows = (
+                    db.session.query(*columns)
+                    .filter(_in_ids(cls.id, chunk), cls.price_cents != price_cents)
+                    .all()
+                )
+                if rows:
+                    yield rows
+            return
+        last_id = None
+        while True:
+            query = db.session.query(*columns).filter(cls.name == name, cls.price_cents != price_cents)
+            if last_id is not None:
+                query = query.filter(cls.id > last_id)
+            rows = query.order_by(cls.id).limit(batch).all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+    @classmethod
+    def _reprice_batch(cls, rows, price_cents):
+        """Updates the price of one batch of rows and commits it with its events"""
+        now = datetime.utcnow()
+        db.session.query(cls).filter(_in_ids(cls.id, [row.id for row in rows])).update(
+            {cls.price_cents: price_cents}, synchronize_session=False
+        )
+        db.session.query(Shopcart).filter(_in_ids(Shopcart.id, {row.shopcart_id for row in rows})).update(
+            {Shopcart.updated_at: now}, synchronize_session=False
+        )
+        CartEvent.record(db.session, [
+            CartEvent.product_row("updated", row.shopcart_id, row.id, row.name, row.quantity, price_cents)
+            for row in rows
+        ])
+        db.session.commit()
+
+    @classmethod
+    def create_partitioned_table(cls, partitions):
+        """
+        Creates the product table hash partitioned by shopcart_id
+
+        Postgres requires the partition key in every unique constraint, so the
+        partitioned table is keyed by (id, shopcart_id) while the mapper keeps
+        using id alone as the identity of a Product.
+        Args:
+            partitions (int): the number of hash partitions to create
+        """
+        table = cls.__table__
+        dialect = db.engine.dialect
+        definitions = [
+            str(CreateColumn(column).compile(dialect=dialect)) for column in table.columns
+        ]
+        definitions.append("PRIMARY KEY (id, shopcart_id)")
+        definitions.append("FOREIGN KEY (shopcart_id) REFERENCES shopcart (id)")
+        with db.engine.begin() as connection:
+            Shopcart.__table__.create(connection, checkfirst=True)
+            if dialect.has_table(connection, table.name):
+                logger.info("Table %s already exists", table.name)
+                return
+            logger.info("Creating %s with %d hash partitions", table.name, partitions)
+            connection.execute(
+                "CREATE TABLE %s (\n\t%s\n) PARTITION BY HASH (shopcart_id)"
+                % (table.name, ",\n\t".join(definitions))
+            )
+            for remainder in range(partitions):
+                connection.execute(
+                    "CREATE TABLE %s_p%d PARTITION OF %s "
+                    "FOR VALUES WITH (MODULUS %d, REMAINDER %d)"
+                    % (table.name, remainder, table.name, partitions, remainder)
+                )
+            for index in table.indexes:
+                index.create(connection)
+            table.dispatch.after_create(table, connection, checkfirst=False, _ddl_runner=None)
+
     def __repr__(self):
         return "<Product %r id=[%s] shopcart[%s]>" % (
             self.name,
@@ -124,16 +353,114 @@ class Product(db.Model, PersistentBase):
                 "Invalid Product: body of request contained "
                 "bad or no data " + error.args[0]
             )
+        except ValueError as error:
+            raise DataValidationError("Invalid Product: " + error.args[0])
         return self
 
     @classmethod
-    def filter_by_product_name(cls, product_name):
+    def filter_by_product_name(cls, product_name, match="exact"):
         """
         Filter products by product_name
         Args:
             product_name(string): the name of the product that will be filtered out
+            match(string): one of MATCH_MODES
+        """
+        return cls.query.filter(cls.name_condition(product_name, match))
+
+    @classmethod
+    def search_by_name(cls, term, match="exact", page=1, per_page=20):
+        """
+        Returns one page of the products whose name matches the term,
+        the most similar first for fuzzy matches
+        Args:
+            term(string): the name, or start of the name, to look for
+            match(string): one of MATCH_MODES
+            page(int): the page to return, starting at 1
+            per_page(int): the number of products on a page
         """
-        return cls.query.filter(cls.name == product_name)
+        logger.info("Searching products for %s match of %s", match, term)
+        if match != "fuzzy":
+            query = cls.filter_by_product_name(term, match).order_by(cls.id)
+        elif cls.has_trigram_support():
+            query = cls.filter_by_product_name(term, match).order_by(
+                db.func.similarity(cls.name, term).desc(), cls.id
+            )
+        else:
+            names = cls._similar_names(term)
+            if not names:
+                return []
+            rank = db.case({name: i for i, name in enumerate(names)}, value=cls.name)
+            query = cls.query.filter(cls.name.in_(names)).order_by(rank, cls.id)
+        return query.limit(per_page).offset((page - 1) * per_page).all()
+
+    @classmethod
+    def name_condition(cls, term, match="exact"):
+        """Returns the SQL condition for the names that match the term"""
+        if match == "icase":
+            return db.func.lower(cls.name) == term.lower()
+        if match == "prefix":
+            pattern = term.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            return db.func.lower(cls.name).like(pattern + "%", escape="\\")
+        if match == "fuzzy":
+            if cls.has_trigram_support():
+                # psycopg2 needs the % operator escaped
+                return cls.name.op("%%")(term)
+            return cls.name.in_(cls._similar_names(term))
+        return cls.name == term
+
+    @classmethod
+    def has_trigram_support(cls):
+        """Returns True when the database has pg_trgm for fuzzy matching"""
+        engine = db.get_engine()
+        if engine not in _trigram_support:
+            _trigram_support[engine] = engine.dialect.name == "postgresql" and bool(
+                engine.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar()
+            )
+        return _trigram_support[engine]
+
+    @classmethod
+    def _similar_names(cls, term):
+        """
+        Returns the distinct product names similar to the term, most similar
+        first. It reads every name, so it only stands in for pg_trgm on SQLite.
+        """
+        if db.get_engine().dialect.name != "sqlite":
+            raise DataValidationError("Invalid search: fuzzy matching needs the pg_trgm extension in the database")
+        names = TrigramIndex(name for (name,) in db.session.query(cls.name).distinct())
+        return [name for name, _ in names.search(term)]
+
+
+# Engines that were checked for the pg_trgm extension
+_trigram_support = {}
+
+# Indexes for product name searches that plain Index() cannot express:
+# lower(name) for case-insensitive and prefix matches, and a trigram
+# index for fuzzy matches when the pg_trgm extension is available
+event.listen(
+    Product.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_product_name_lower ON %(table)s (lower(name) text_pattern_ops)")
+    .execute_if(dialect="postgresql"),
+)
+event.listen(
+    Product.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_product_name_lower ON %(table)s (lower(name))")
+    .execute_if(callable_=lambda ddl, target, bind, **kw: bind.dialect.name != "postgresql"),
+)
+event.listen(
+    Product.__table__,
+    "after_create",
+    DDL(
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+        "CREATE INDEX ix_product_name_trgm ON %(table)s USING gin (name gin_trgm_ops)"
+    ).execute_if(
+        dialect="postgresql",
+        callable_=lambda ddl, target, bind, **kw: bool(
+            bind.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").scalar()
+        ),
+    ),
+)
 
 
 ######################################################################
@@ -148,6 +475,7 @@ class Shopcart(db.Model, PersistentBase):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     products = db.relationship("Product", backref="shopcart", passive_deletes=True)
 
     def __repr__(self):
@@ -161,24 +489,135 @@ class Shopcart(db.Model, PersistentBase):
         db.session.commit()
 
     def delete(self):
-        """Removes a Shopcart from the data store"""
+        """Removes a Shopcart and its products from the data store"""
         logger.info("Deleting %s", self.id)
-        if self.products:
-            logger.info("delete")
-            for product in self.products:
-                product.delete()
+        for product in self.products:
+            db.session.delete(product)
         deletedCnt = db.session.delete(self)
         db.session.commit()
         return deletedCnt
 
+    def clear(self):
+        """Removes all of the products of a Shopcart in one transaction"""
+        logger.info("Clearing %s", self.id)
+        for product in self.products:
+            db.session.delete(product)
+        self.products = []
+        db.session.commit()
+
+    @classmethod
+    def merge(cls, id, from_id):
+        """
+        Moves the products of one Shopcart into another in one transaction
+        Products with a name that is already in the target add their
+        quantity to its first line with that name, the others are moved
+        over, and the source Shopcart is deleted. The target is created
+        when it does not exist yet.
+        Args:
+            id (Integer): the id of the Shopcart to merge into
+            from_id (Integer): the id of the Shopcart to merge and delete
+        Returns:
+            the merged Shopcart, or None, with nothing written, when there is
+            no source Shopcart
+        """
+        if id == from_id:
+            raise DataValidationError("Invalid merge: a Shopcart cannot be merged into itself")
+        logger.info("Merging %s into %s", from_id, id)
+        # lock the carts that exist, in id order so opposite merges cannot deadlock
+        locked = db.session.query(cls.id).filter(cls.id.in_([id, from_id])).order_by(cls.id).with_for_update().all()
+        if from_id not in {row.id for row in locked}:
+            return None
+        cls.insert_if_absent(id)
+        columns = (Product.id, Product.name, Product.quantity, Product.price_cents)
+        target = db.session.query(*columns).filter(Product.shopcart_id == id).order_by(Product.id).all()
+        source = db.session.query(*columns).filter(Product.shopcart_id == from_id).order_by(Product.id).all()
+        cls._merge_products(id, from_id)
+        CartEvent.record(db.session, cls._merge_events(id, from_id, target, source))
+        db.session.commit()
+        return cls.find_by_id(id)
+
+    @staticmethod
+    def _merge_products(id, from_id):
+        """Merges the product rows of one Shopcart into another with four statements"""
+        product = Product.__table__
+        source, target = product.alias("source"), product.alias("target")
+        source_names = select([source.c.name]).where(source.c.shopcart_id == from_id)
+        target_names = select([target.c.name]).where(target.c.shopcart_id == id)
+        first_lines = select([db.func.min(target.c.id)]).where(target.c.shopcart_id == id).group_by(target.c.name)
+        added = (
+            select([db.func.sum(source.c.quantity)])
+            .where(and_(source.c.shopcart_id == from_id, source.c.name == product.c.name))
+            .as_scalar()
+        )
+        db.session.execute(
+            product.update()
+            .where(and_(product.c.id.in_(first_lines), product.c.name.in_(source_names)))
+            .values(quantity=product.c.quantity + added)
+        )
+        db.session.execute(
+            product.delete().where(and_(product.c.shopcart_id == from_id, product.c.name.in_(target_names)))
+        )
+        db.session.execute(product.update().where(product.c.shopcart_id == from_id).values(shopcart_id=id))
+        db.session.execute(Shopcart.__table__.delete().where(Shopcart.__table__.c.id == from_id))
+        db.session.execute(
+            Shopcart.__table__.update().where(Shopcart.__table__.c.id == id).values(updated_at=datetime.utcnow())
+        )
+
+    @staticmethod
+    def _merge_events(id, from_id, target, source):
+        """Returns the event rows of a merge from the product rows it started with"""
+        first_lines = {}
+        for row in target:
+            first_lines.setdefault(row.name, [row.id, row.quantity, row.price_cents])
+        events, updated = [], {}
+        for row in source:
+            events.append(CartEvent.product_row("deleted", from_id, row.id, row.name, row.quantity, row.price_cents))
+            line = first_lines.get(row.name)
+            if line:
+                line[1] += row.quantity
+                updated[line[0]] = (row.name, line[1], line[2])
+            else:
+                events.append(CartEvent.product_row("created", id, row.id, row.name, row.quantity, row.price_cents))
+        events.append({"type": "shopcart.deleted", "shopcart_id": from_id})
+        events.extend(
+            CartEvent.product_row("updated", id, product_id, *values) for product_id, values in updated.items()
+        )
+        return events
+
     def create(self, id):
         """
         Creates a Shopcart to the database
+        The row is inserted with one atomic statement, so concurrent creates
+        of the same id cannot both pass a check and then collide
+        Returns:
+            False, with nothing changed and the transaction left open, when
+            the Shopcart already exists
         """
         logger.info("Creating %s", id)
-        self.id = id  # id must be none to generate next primary key
+        self.id = id
+        if not Shopcart.insert_if_absent(id):
+            return False
+        for product in self.products:
+            product.shopcart_id = id
+        # the row is in, so only the products are left for the flush to insert
+        orm.make_transient_to_detached(self)
         db.session.add(self)
         db.session.commit()
+        return True
+
+    @classmethod
+    def insert_if_absent(cls, id):
+        """
+        Inserts an empty Shopcart row unless one with the id exists, with
+        INSERT ... ON CONFLICT DO NOTHING on Postgres and INSERT OR IGNORE on
+        SQLite. The transaction is left open.
+        Returns:
+            True if the row was inserted
+        """
+        inserted = _insert_if_absent(cls.__table__, {"id": id, "updated_at": datetime.utcnow()})
+        if inserted:
+            CartEvent.record(db.session, [{"type": "shopcart.created", "shopcart_id": id}])
+        return inserted
 
     def serialize(self):
         """Serializes a Shopcart into a dictionary"""
@@ -198,17 +637,7 @@ class Shopcart(db.Model, PersistentBase):
         """
         try:
             self.id = data["id"]
-            # handle inner list of products
-            product_list = data.get("products")
-            if product_list:
-                for product in self.products:
-                    product.delete()
-            for json_product in product_list:
-                product = Product()
-                product.deserialize(json_product)
-                product.shopcart_id = self.id
-                self.products.append(product)
-            self.update()
+            self.replace_products(data["products"])
         except KeyError as error:
             raise DataValidationError("Invalid Shopcart: missing " + error.args[0])
         except TypeError as error:
@@ -218,14 +647,81 @@ class Shopcart(db.Model, PersistentBase):
             )
         return self
 
+    def replace_products(self, items):
+        """
+        Makes the products of a Shopcart match a list of product dictionaries
+        Items are matched to the products by id: a match is updated in place,
+        an item without one is added, and the products that no item names
+        are removed. The flush only writes the rows whose values changed,
+        and nothing is committed.
+        Args:
+            items (list): dictionaries like the ones Product.deserialize takes
+        """
+        current = {product.id: product for product in self.products}
+        for item in items:
+            product = current.pop(item.get("id"), None)
+            if product is None:
+                product = Product()
+                self.products.append(product)
+            product.deserialize(item)
+            product.shopcart_id = self.id
+        for product in current.values():
+            self.products.remove(product)
+            if orm.object_session(product) is not None:
+                db.session.delete(product)
+
     @classmethod
-    def filter_by_product_name(cls, product_name):
+    def filter_by_product_name(cls, product_name, match="exact"):
         """Returns Shopcarts which has the give product_name"""
         logger.info("Product name is: %s", product_name)
-        selected_products = Product.filter_by_product_name(product_name)
-        return [
-            Shopcart.find_by_id(product.shopcart_id) for product in selected_products
-        ]
+        return (
+            cls.query.filter(cls.products.any(Product.name_condition(product_name, match)))
+            .order_by(cls.id)
+            .all()
+        )
+
+    @classmethod
+    def find_by_filters(cls, filters):
+        """
+        Returns the Shopcarts that match all of the filters, using one query
+        Args:
+            filters (dict): any of id, id_min, id_max, name (and match),
+                subtotal_min, subtotal_max, quantity_min, quantity_max and
+                updated_since; filters that are None are ignored
+        """
+        filters = {key: value for key, value in filters.items() if value is not None}
+        logger.info("Processing filter query for %s ...", filters)
+        totals = (
+            db.session.query(
+                Product.shopcart_id.label("shopcart_id"),
+                db.func.sum(Product.price_cents * Product.quantity).label("subtotal"),
+                db.func.sum(Product.quantity).label("quantity"),
+            )
+            .group_by(Product.shopcart_id)
+            .subquery()
+        )
+        subtotal = db.func.coalesce(totals.c.subtotal, 0)
+        quantity = db.func.coalesce(totals.c.quantity, 0)
+        conditions = {
+            "id": lambda value: cls.id == value,
+            "id_min": lambda value: cls.id >= value,
+            "id_max": lambda value: cls.id <= value,
+            "name": lambda value: cls.products.any(
+                Product.name_condition(value, filters.get("match", "exact"))
+            ),
+            "subtotal_min": lambda value: subtotal >= to_cents(value),
+            "subtotal_max": lambda value: subtotal <= to_cents(value),
+            "quantity_min": lambda value: quantity >= value,
+            "quantity_max": lambda value: quantity <= value,
+            "updated_since": lambda value: cls.updated_at >= _naive_utc(value),
+        }
+        query = cls.query.options(orm.selectinload(cls.products))
+        if any(key.startswith(("subtotal_", "quantity_")) for key in filters):
+            query = query.outerjoin(totals, totals.c.shopcart_id == cls.id)
+        for key, value in filters.items():
+            if key in conditions:
+                query = query.filter(conditions[key](value))
+        return query.order_by(cls.id).all()
 
     @classmethod
     def find_by_id(cls, id):
@@ -235,3 +731,608 @@ class Shopcart(db.Model, PersistentBase):
         """
         logger.info("Processing id query for %s ...", id)
         return cls.query.filter(cls.id == id).first()
+
+    @classmethod
+    def exists(cls, id):
+        """Returns True if there is a Shopcart with the given customer id
+        This is a SELECT id ... LIMIT 1 on the primary key, nothing is loaded
+        Args:
+            id (Integer): the id of the customer you want to match
+        """
+        logger.info("Processing exists query for %s ...", id)
+        return db.session.query(cls.id).filter(cls.id == id).limit(1).first() is not None
+
+    @classmethod
+    def existing_ids(cls, ids):
+        """Returns the set of the given customer ids that have a Shopcart"""
+        ids = list(ids)
+        if not ids:
+            return set()
+        return {id for (id,) in db.session.query(cls.id).filter(cls.id.in_(ids))}
+
+    @classmethod
+    def subtotals(cls, ids):
+        """
+        Returns the subtotal of each of the Shopcarts in whole cents, summed
+        exactly by the database in one query
+        Args:
+            ids (list): the ids of the Shopcarts, a cart without products
+                has a subtotal of 0 and an unknown cart is left out
+        """
+        ids = list(ids)
+        logger.info("Processing subtotals for %d shopcarts ...", len(ids))
+        if not ids:
+            return {}
+        rows = (
+            db.session.query(cls.id, db.func.coalesce(db.func.sum(Product.price_cents * Product.quantity), 0))
+            .outerjoin(Product, Product.shopcart_id == cls.id)
+            .filter(cls.id.in_(ids))
+            .group_by(cls.id)
+        )
+        return {id: int(cents) for id, cents in rows}
+
+
+######################################################################
+#  C A R T   E V E N T   M O D E L
+######################################################################
+class CartEvent(db.Model):
+    """
+    Class that represents one change to a Shopcart or Product
+
+    Events are written to this outbox table in the same transaction as
+    the change itself, so consumers can read the changes in position order
+    instead of polling full snapshots of the carts.
+
+    Ids are taken when a row is inserted but become visible when its
+    transaction commits, so two transactions can commit their ids out of
+    order. The position is the cursor instead: it is numbered just before
+    the commit, while a lock keeps other transactions from numbering
+    theirs, so every position becomes visible after all the lower ones.
+    """
+
+    # Table Schema
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    position = db.Column(db.BigInteger)
+    type = db.Column(db.String(16), nullable=False)
+    shopcart_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer)
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index("ix_cart_event_position", "position", unique=True),
+        # finds the events of a transaction that still need a position
+        db.Index(
+            "ix_cart_event_unpositioned", "id",
+            postgresql_where=position.is_(None), sqlite_where=position.is_(None),
+        ),
+    )
+
+    def __repr__(self):
+        return "<CartEvent %r id=[%s] shopcart[%s]>" % (self.type, self.id, self.shopcart_id)
+
+    def serialize(self):
+        """Serializes a CartEvent into a dictionary, its position is the id consumers see"""
+        return {
+            "id": self.position,
+            "type": self.type,
+            "shopcart_id": self.shopcart_id,
+            "product_id": self.product_id,
+            "data": json.loads(self.data) if self.data else None,
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @classmethod
+    def since(cls, cursor, limit=100):
+        """Returns up to limit events whose position comes after the cursor, oldest first"""
+        logger.info("Processing events since %s ...", cursor)
+        return cls.query.filter(cls.position > cursor).order_by(cls.position).limit(limit).all()
+
+    @classmethod
+    def purged_after(cls, cursor):
+        """Returns True when events right after the cursor were purged already"""
+        if cursor <= 0:
+            return False
+        oldest = db.session.query(db.func.min(cls.position)).scalar()
+        return oldest is not None and oldest > cursor + 1
+
+    @classmethod
+    def purge(cls, before):
+        """
+        Deletes the events that were written before a time, returns how many.
+        The last event is always kept, the next positions are numbered after it.
+        """
+        logger.info("Purging the events before %s", before)
+        last = db.session.query(db.func.max(cls.position)).scalar() or 0
+        count = cls.query.filter(cls.created_at < before, cls.position < last).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def reset(cls, session):
+        """
+        Replaces the events with one that tells consumers every cart was
+        reset, in the session's transaction. The last event is kept, so a
+        consumer at the head reads the reset and one behind it gets a 410.
+        """
+        last = session.query(db.func.max(cls.position)).scalar() or 0
+        session.query(cls).filter(cls.position < last).delete(synchronize_session=False)
+        cls.record(session, [{"type": "shopcarts.reset", "shopcart_id": 0}])
+
+    @classmethod
+    def number(cls, session):
+        """
+        Gives the events of the session's transaction the next positions.
+        Runs right before the commit, and on Postgres holds a lock on the
+        numbering until the transaction ends.
+        """
+        connection = session.connection()
+        table = cls.__table__
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                text("SELECT pg_advisory_xact_lock(CAST(CAST(CAST(:name AS regclass) AS oid) AS bigint))"),
+                name=table.name,
+            )
+            connection.execute(text(
+                "UPDATE cart_event SET position = numbered.position FROM ("
+                " SELECT id, (SELECT coalesce(max(position), 0) FROM cart_event)"
+                " + row_number() OVER (ORDER BY id) AS position FROM cart_event WHERE position IS NULL"
+                ") AS numbered WHERE cart_event.id = numbered.id"
+            ))
+            return
+        # other databases write one transaction at a time
+        last = connection.execute(select([db.func.coalesce(db.func.max(table.c.position), 0)])).scalar()
+        ids = connection.execute(select([table.c.id]).where(table.c.position.is_(None)).order_by(table.c.id))
+        rows = [{"row_id": id, "row_position": last + i} for i, (id,) in enumerate(ids, start=1)]
+        if rows:
+            connection.execute(
+                table.update().where(table.c.id == bindparam("row_id")).values(position=bindparam("row_position")),
+                rows,
+            )
+
+    @classmethod
+    def record(cls, session, rows):
+        """
+        Writes event rows with the session's connection, for changes that
+        bypass the unit of work such as bulk updates
+        Args:
+            rows (list): dictionaries with type, shopcart_id and optionally
+                product_id and data
+        """
+        if rows:
+            now = datetime.utcnow()
+            copy_rows(
+                session.connection(),
+                cls.__table__,
+                ["type", "shopcart_id", "product_id", "data", "created_at"],
+                ((row["type"], row["shopcart_id"], row.get("product_id"), row.get("data"), now) for row in rows),
+            )
+            session.info["unnumbered_events"] = True
+            cls.notify(session, rows)
+
+    @staticmethod
+    def notify(session, rows):
+        """
+        Announces which Shopcarts the event rows changed once the transaction
+        commits. Postgres delivers NOTIFY messages to every worker on commit,
+        other databases are announced to this process only
+        """
+        types = defaultdict(set)
+        for row in rows:
+            types[row["shopcart_id"]].add(row["type"])
+        messages = [{"shopcart_id": key, "types": sorted(value)} for key, value in types.items()]
+        if session.connection().dialect.name == "postgresql":
+            # one statement for all of the carts, however many a bulk change touched
+            session.execute(
+                text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+                {
+                    "channel": CART_CHANGES_CHANNEL,
+                    "payloads": [json.dumps(message, separators=(",", ":")) for message in messages],
+                },
+            )
+        else:
+            session.info.setdefault("cart_changes", []).extend(messages)
+
+    @staticmethod
+    def row_for(instance, change):
+        """Returns the event row for a change to a Shopcart or Product, or None"""
+        if isinstance(instance, Shopcart) and change != "updated":
+            return {"type": "shopcart." + change, "shopcart_id": instance.id}
+        if isinstance(instance, Product):
+            return CartEvent.product_row(
+                change, instance.shopcart_id, instance.id, instance.name, instance.quantity, instance.price_cents
+            )
+        return None
+
+    @staticmethod
+    def product_row(change, shopcart_id, product_id, name, quantity, price_cents):
+        """Returns the event row for a change to a product, with its new values unless it was deleted"""
+        data = None
+        if change != "deleted":
+            data = json.dumps(
+                {"name": name, "quantity": quantity, "price": from_cents(price_cents)}, separators=(",", ":")
+            )
+        return {"type": "product." + change, "shopcart_id": shopcart_id, "product_id": product_id, "data": data}
+
+
+######################################################################
+#  C A R T   S N A P S H O T   M O D E L
+######################################################################
+class CartSnapshot(db.Model):
+    """
+    Class that represents a saved copy of the products of a Shopcart
+
+    Snapshots never change. Their lines are kept in one compressed blob,
+    so saving a cart adds a single row here and nothing to the product
+    table or its indexes. Snapshots outlive the Shopcart they were taken of.
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    shopcart_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(64))
+    line_count = db.Column(db.Integer, nullable=False)
+    lines_blob = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_cart_snapshot_shopcart_id_id", "shopcart_id", "id"),)
+
+    def __repr__(self):
+        return "<CartSnapshot %r id=[%s] shopcart[%s]>" % (self.name, self.id, self.shopcart_id)
+
+    @property
+    def lines(self):
+        """The (name, quantity, price_cents) lines that were saved"""
+        return snapshot.decode_lines(self.lines_blob)
+
+    def serialize(self, lines=False):
+        """Serializes a CartSnapshot into a dictionary, with its products when asked"""
+        data = {
+            "id": self.id,
+            "shopcart_id": self.shopcart_id,
+            "name": self.name,
+            "line_count": self.line_count,
+            "created_at": self.created_at.isoformat(),
+        }
+        if lines:
+            data["products"] = [_line_dict(*line) for line in self.lines]
+        return data
+
+    @classmethod
+    def take(cls, shopcart_id, name=None):
+        """
+        Saves the products of a Shopcart as a new snapshot
+        Returns:
+            the CartSnapshot, or None when the Shopcart does not exist
+        """
+        logger.info("Taking a snapshot of %s", shopcart_id)
+        if not Shopcart.exists(shopcart_id):
+            return None
+        lines = cls.current_lines(shopcart_id)
+        taken = cls(
+            shopcart_id=shopcart_id, name=name, line_count=len(lines), lines_blob=snapshot.encode_lines(lines)
+        )
+        db.session.add(taken)
+        db.session.commit()
+        return taken
+
+    @staticmethod
+    def current_lines(shopcart_id):
+        """Returns the (name, quantity, price_cents) lines that a Shopcart holds now"""
+        return (
+            db.session.query(Product.name, Product.quantity, Product.price_cents)
+            .filter(Product.shopcart_id == shopcart_id)
+            .order_by(Product.id)
+            .all()
+        )
+
+    @classmethod
+    def find_for(cls, shopcart_id, by_id):
+        """Finds a snapshot by it's ID, or None when it was not taken of the Shopcart"""
+        logger.info("Processing lookup for snapshot %s of %s ...", by_id, shopcart_id)
+        return cls.query.filter(cls.shopcart_id == shopcart_id, cls.id == by_id).first()
+
+    @classmethod
+    def all_for(cls, shopcart_id):
+        """Returns the snapshots of a Shopcart, newest first, without loading their lines"""
+        logger.info("Processing snapshots of %s ...", shopcart_id)
+        return (
+            cls.query.options(orm.defer(cls.lines_blob))
+            .filter(cls.shopcart_id == shopcart_id)
+            .order_by(cls.id.desc())
+            .all()
+        )
+
+    def restore(self):
+        """Replaces the products of the Shopcart with the saved ones, returns the Shopcart"""
+        logger.info("Restoring snapshot %s of %s", self.id, self.shopcart_id)
+        Shopcart.insert_if_absent(self.shopcart_id)
+        shopcart = Shopcart.find_by_id(self.shopcart_id)
+        for product in shopcart.products:
+            db.session.delete(product)
+        shopcart.products = [
+            Product(name=name, quantity=quantity, price_cents=price_cents, shopcart_id=self.shopcart_id)
+            for name, quantity, price_cents in self.lines
+        ]
+        db.session.commit()
+        return shopcart
+
+    def diff(self, lines):
+        """
+        Compares the saved products with other (name, quantity, price_cents)
+        lines by name, returns what was added, removed and changed since
+        """
+        changes = snapshot.diff_lines(self.lines, lines)
+        return {
+            "added": [_line_dict(*line) for line in changes["added"]],
+            "removed": [_line_dict(*line) for line in changes["removed"]],
+            "changed": [
+                {"name": name, "old": _line_dict(None, *old), "new": _line_dict(None, *new)}
+                for name, old, new in changes["changed"]
+            ],
+        }
+
+
+def _line_dict(name, quantity, price_cents):
+    """Returns a snapshot line the way the API shows it, without a name when it is None"""
+    line = {"name": name, "quantity": quantity, "price": from_cents(price_cents)}
+    if name is None:
+        del line["name"]
+    return line
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response of a request that
+    was made with an Idempotency-Key header
+    """
+
+    # Table Schema
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    # the status_code of a key whose request has not finished yet
+    PENDING = 0
+
+    def __repr__(self):
+        return "<IdempotencyKey %r status=[%s]>" % (self.key, self.status_code)
+
+    @classmethod
+    def claim(cls, key, fingerprint, expires):
+        """
+        Reserves a key for a request that is about to run. The pending row
+        is left in the session's transaction, so it commits together with
+        the request's writes and is rolled back with them. A concurrent
+        claim of the same key waits for that transaction on Postgres.
+        Returns:
+            True if the key was free
+        """
+        cls.query.filter(cls.key == key, cls.expires <= datetime.utcnow()).delete(synchronize_session=False)
+        return _insert_if_absent(
+            cls.__table__,
+            {"key": key, "fingerprint": fingerprint, "status_code": cls.PENDING, "response": "", "expires": expires},
+        )
+
+
+def _insert_if_absent(table, values):
+    """
+    Inserts a row unless its primary key is taken, with INSERT ... ON
+    CONFLICT DO NOTHING on Postgres and INSERT OR IGNORE on SQLite. The
+    transaction is left open.
+    Returns:
+        True if the row was inserted
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(table).values(values).on_conflict_do_nothing(
+            index_elements=[column.name for column in table.primary_key]
+        )
+    elif dialect == "sqlite":
+        statement = table.insert().values(values).prefix_with("OR IGNORE")
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(values))
+            return True
+        except IntegrityError:
+            return False
+    return db.session.execute(statement).rowcount == 1
+
+
+def _in_ids(column, ids):
+    """
+    Returns the condition that a column is one of the ids. Postgres gets
+    them as one array parameter, which is much cheaper to build and send
+    than thousands of IN parameters
+    """
+    ids = list(ids)
+    if db.session.get_bind().dialect.name == "postgresql":
+        return column == db.func.any(bindparam(None, ids, type_=postgresql.ARRAY(column.type)))
+    return column.in_(ids)
+
+
+def _naive_utc(moment):
+    """Converts an aware datetime to the naive UTC time the tables store"""
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def touch_shopcarts(session, flush_context, instances):
+    """Stamps updated_at on the Shopcarts whose products change in a flush"""
+    now = datetime.utcnow()
+    shopcart_ids = set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Shopcart):
+            instance.updated_at = now
+        elif isinstance(instance, Product):
+            shopcart = instance.shopcart
+            if shopcart is None and instance.shopcart_id is not None:
+                shopcart_ids.add(instance.shopcart_id)
+            elif shopcart is not None and shopcart not in session.deleted:
+                shopcart.updated_at = now
+    if shopcart_ids:
+        session.query(Shopcart).filter(Shopcart.id.in_(shopcart_ids)).update(
+            {Shopcart.updated_at: now}, synchronize_session=False
+        )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def write_cart_events(session, flush_context):
+    """Writes a CartEvent for every Shopcart and Product change of a flush"""
+    changes = chain(
+        ((instance, "created") for instance in session.new),
+        (
+            (instance, "updated")
+            for instance in session.dirty
+            if session.is_modified(instance, include_collections=False)
+        ),
+        ((instance, "deleted") for instance in session.deleted),
+    )
+    rows = [CartEvent.row_for(instance, change) for instance, change in changes]
+    CartEvent.record(session, [row for row in rows if row])
+
+
+@event.listens_for(RoutingSession, "before_commit")
+def number_cart_events(session):
+    """Gives the events written in the transaction their positions"""
+    session.flush()  # the commit's own flush comes after this hook, and writes events too
+    if session.info.pop("unnumbered_events", False):
+        CartEvent.number(session)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def publish_cart_changes(session):
+    """Announces the committed cart changes that were not sent with NOTIFY"""
+    if session.transaction.parent is not None:
+        return  # a savepoint was released, the transaction goes on
+    for message in session.info.pop("cart_changes", ()):
+        cart_changes.publish(message["shopcart_id"], message)
+
+
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def discard_cart_changes(session, previous_transaction):
+    """Forgets the cart changes of a transaction that was rolled back"""
+    if previous_transaction.parent is None:
+        # a rolled back savepoint keeps them, a spare notification is harmless
+        session.info.pop("cart_changes", None)
+        session.info.pop("unnumbered_events", None)
+
+
+def watch_cart_changes(timeout=5.0):
+    """
+    Makes sure the cart changes of other worker processes reach this one.
+    On Postgres this starts a thread that LISTENs for them, and waits up
+    to timeout seconds for it to be ready
+    """
+    global _cart_changes_listener  # pylint: disable=global-statement
+    if db.engine.dialect.name != "postgresql":
+        return
+    with _cart_changes_lock:
+        if _cart_changes_listener is None or not _cart_changes_listener.is_alive():
+            _cart_changes_listener = NotificationListener(
+                db.engine, CART_CHANGES_CHANNEL, cart_changes, "shopcart_id"
+            )
+            _cart_changes_listener.start()
+    _cart_changes_listener.ready.wait(timeout)
+
+
+def create_tables(partitions=0):
+    """
+    Creates all of the tables that do not exist yet
+    Args:
+        partitions (int): hash partition the product table into this many
+            partitions when running on Postgres (0 leaves it unpartitioned)
+    """
+    if partitions and db.engine.dialect.name == "postgresql":
+        Product.create_partitioned_table(partitions)
+    db.create_all()
+
+
+def migrate_schema(connection):
+    """
+    Adds what a database made before the shopcart updated_at column, the
+    product lookup index and the event positions is missing. Every step is skipped when it is done
+    already, so it is safe to run again.
+    Args:
+        connection: the SQLAlchemy Connection to migrate in, the caller
+            commits the transaction
+    Returns:
+        a description of every change that was made
+    """
+    inspector = inspect(connection)
+    changes = []
+    if "updated_at" not in {column["name"] for column in inspector.get_columns("shopcart")}:
+        logger.info("Adding shopcart.updated_at")
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                "ALTER TABLE shopcart ADD COLUMN updated_at TIMESTAMP WITHOUT TIME ZONE "
+                "NOT NULL DEFAULT timezone('utc', now())"
+            )
+            connection.execute("ALTER TABLE shopcart ALTER COLUMN updated_at DROP DEFAULT")
+        else:
+            # SQLite only adds columns with a constant default
+            connection.execute("ALTER TABLE shopcart ADD COLUMN updated_at DATETIME NOT NULL DEFAULT '1970-01-01'")
+            connection.execute("UPDATE shopcart SET updated_at = datetime('now')")
+        changes.append("added shopcart.updated_at")
+    tables = set(inspector.get_table_names())
+    if "cart_event" in tables and "position" not in {column["name"] for column in inspector.get_columns("cart_event")}:
+        logger.info("Adding cart_event.position")
+        # the ids were the cursors so far, so they keep working as positions
+        connection.execute("ALTER TABLE cart_event ADD COLUMN position BIGINT")
+        connection.execute("UPDATE cart_event SET position = id")
+        changes.append("added cart_event.position")
+    for table in (Shopcart.__table__, Product.__table__, CartEvent.__table__):
+        if table.name not in tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                statement = str(CreateIndex(index).compile(dialect=connection.dialect))
+                connection.execute(statement.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+                changes.append("created index " + index.name)
+    # the single column index that ix_product_shopcart_id_id replaced
+    if "ix_product_shopcart_id" in {index["name"] for index in inspector.get_indexes("product")}:
+        connection.execute("DROP INDEX ix_product_shopcart_id")
+        changes.append("dropped index ix_product_shopcart_id")
+    return changes
+
+
+def migrate_prices(connection):
+    """
+    Moves the prices of a product table made before they were stored as
+    whole cents from the float price column to price_cents
+    Args:
+        connection: the SQLAlchemy Connection to migrate in, the caller
+            commits the transaction
+    Returns:
+        the number of migrated products, or None when there was nothing to do
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns("product")}
+    if "price" not in columns or "price_cents" in columns:
+        return None
+    logger.info("Migrating the product prices to whole cents")
+    if connection.dialect.name == "postgresql":
+        connection.execute("ALTER TABLE product ADD COLUMN price_cents BIGINT")
+        # numeric rounds half away from zero, like to_cents()
+        count = connection.execute("UPDATE product SET price_cents = round(price::numeric * 100)").rowcount
+        connection.execute("ALTER TABLE product ALTER COLUMN price_cents SET NOT NULL")
+    else:
+        # other databases cannot round like to_cents(), so the rows are converted here
+        connection.execute("ALTER TABLE product ADD COLUMN price_cents BIGINT NOT NULL DEFAULT 0")
+        rows = [
+            {"row_id": id, "cents": to_cents(price)}
+            for id, price in connection.execute("SELECT id, price FROM product")
+        ]
+        if rows:
+            connection.execute(text("UPDATE product SET price_cents = :cents WHERE id = :row_id"), rows)
+        count = len(rows)
+    connection.execute("ALTER TABLE product DROP COLUMN price")
+    return count
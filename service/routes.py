@@ -6,16 +6,44 @@ Paths:
 GET / - Displays a UI for Selenium testing
 GET /shopcarts - Returns a list all of the Shopcarts
 GET /shopcarts/{id} - Returns the Shopcart with a given id number
+HEAD /shopcarts/{id} - Checks that the Shopcart with a given id number exists
 POST /shopcarts - creates a new Shopcart record in the database
 PUT /shopcarts/{id} - updates a Shopcart record in the database
 DELETE /shopcarts/{id} - deletes a Shopcart record in the database
+POST /shopcarts/{id}/merge?from={id} - Merges another Shopcart into a Shopcart
+GET /shopcarts/{id}/snapshots - Returns the saved copies of a Shopcart
+POST /shopcarts/{id}/snapshots - Saves a copy of a Shopcart
+GET /shopcarts/{id}/snapshots/{snapshot_id} - Returns a saved copy with its Products
+DELETE /shopcarts/{id}/snapshots/{snapshot_id} - Deletes a saved copy
+POST /shopcarts/{id}/snapshots/{snapshot_id}/restore - Restores the Products of a saved copy
+GET /shopcarts/{id}/snapshots/{snapshot_id}/diff - Compares a saved copy with the Shopcart or another copy
+GET /shopcarts/{id}/stream - Streams change notifications for a Shopcart
+GET /products - Searches the Products by name
+POST /products/reprice - Changes the price of a Product in every Shopcart
+POST /shopcarts/{id}/quote - Prices a Shopcart with promotion rules and a tax rate
+POST /quotes - Prices many Shopcarts with promotion rules and a tax rate
+GET /events - Returns the changes to the Shopcarts after a cursor
+PUT /admin/reset - replaces every Shopcart with a fixture (test environments only)
+POST /batch - runs several of the operations above in one transaction
 """
 
+import hmac
+import json
 import logging
-from flask import request, abort
-from flask_restx import Resource, fields
-from service.models import Product, Shopcart
+import time
+from urllib.parse import parse_qs, urlsplit
+from flask import request, abort, session, make_response, Response
+from flask_restx import Resource, fields, inputs
+from sqlalchemy.exc import IntegrityError
+from werkzeug.test import EnvironBuilder
+from service.models import (
+    db, Product, Shopcart, CartEvent, CartSnapshot, REPLICA_BIND, cart_changes, watch_cart_changes
+)
 from service.utils import status  # HTTP Status Codes
+from service.utils import compression, pricing, transfer
+from service.utils.broadcast import RESYNC
+from service.utils.idempotency import idempotent
+from service.utils.validation import Validator
 from . import app, api
 
 ######################################################################
@@ -26,7 +54,9 @@ from . import app, api
 @app.route("/")
 def index():
     """Index page"""
-    return app.send_static_file("index.html")
+    response = make_response(compression.versioned_html(app.static_folder, "index.html"))
+    response.cache_control.no_cache = True
+    return response
 
 
 create_model = api.model(
@@ -49,9 +79,9 @@ product_model = api.model(
     # create_model,
     {
         "id": fields.Integer(
-            readOnly=True, description="The unique id assigned internally by service"
+            readonly=True, description="The unique id assigned internally by service"
         ),
-        "name": fields.String(required=True, description="The name of the Product", maxLength=260),
+        "name": fields.String(required=True, description="The name of the Product", max_length=260),
         "quantity": fields.Integer(
             required=True, description="The quantity of the Product"
         ),
@@ -73,16 +103,94 @@ shopcart_model = api.model(
     },
 )
 
-product_parser = api.parser()
-product_parser.add_argument('id', type=int)
-product_parser.add_argument('name', type=str)
-product_parser.add_argument('quantity', type=int)
-product_parser.add_argument('price', type=float)
-product_parser.add_argument('shopcart_id', type=int)
+# the URL names the shop cart, so the bodies may leave out shopcart_id
+product_body = Validator(product_model, optional=("shopcart_id",))
+shopcart_body = Validator(shopcart_model, optional=("shopcart_id",))
+
+shopcart_create_args = api.parser()
+shopcart_create_args.add_argument(
+    'upsert', type=inputs.boolean, default=False, location='args',
+    help='Replace the products of an existing cart with a 200 instead of a 409'
+)
+
+shopcart_args = api.parser()
+shopcart_args.add_argument('id', type=int, location='args', help='Only the cart with this id')
+shopcart_args.add_argument('id_min', type=int, location='args', help='Only carts with at least this id')
+shopcart_args.add_argument('id_max', type=int, location='args', help='Only carts with at most this id')
+shopcart_args.add_argument('name', type=str, location='args', help='Only carts with this product')
+shopcart_args.add_argument(
+    'match', choices=Product.MATCH_MODES, default='exact', location='args',
+    help='How the product name is matched'
+)
+shopcart_args.add_argument('subtotal_min', type=float, location='args', help='Only carts worth at least this')
+shopcart_args.add_argument('subtotal_max', type=float, location='args', help='Only carts worth at most this')
+shopcart_args.add_argument('quantity_min', type=int, location='args', help='Only carts with at least this many items')
+shopcart_args.add_argument('quantity_max', type=int, location='args', help='Only carts with at most this many items')
+shopcart_args.add_argument(
+    'updated_since', type=inputs.datetime_from_iso8601, location='args',
+    help='Only carts changed at or after this ISO 8601 time'
+)
+
+product_search_args = api.parser()
+product_search_args.add_argument('name', type=str, required=True, location='args')
+product_search_args.add_argument(
+    'match', choices=Product.MATCH_MODES, default='exact', location='args',
+    help='How the product name is matched'
+)
+product_search_args.add_argument('page', type=int, default=1, location='args')
+product_search_args.add_argument('per_page', type=int, default=20, location='args')
+
+event_model = api.model(
+    "CartEvent",
+    {
+        "id": fields.Integer(readonly=True, description="The cursor of the event"),
+        "type": fields.String(readonly=True, description="What changed, e.g. product.created"),
+        "shopcart_id": fields.Integer(readonly=True, description="The shop cart that changed"),
+        "product_id": fields.Integer(readonly=True, description="The product that changed"),
+        "data": fields.Raw(readonly=True, description="The new values of the product"),
+        "created_at": fields.String(readonly=True, description="When the change was made"),
+    },
+)
+event_feed_model = api.model(
+    "CartEventFeed",
+    {
+        "events": fields.List(fields.Nested(event_model)),
+        "cursor": fields.Integer(description="Pass as since to get the next events"),
+    },
+)
+
+event_args = api.parser()
+event_args.add_argument('since', type=int, default=0, location='args', help='Events after this cursor')
+event_args.add_argument('limit', type=int, default=100, location='args', help='At most this many events')
+event_args.add_argument(
+    'wait', type=float, default=0, location='args',
+    help='Seconds to wait for new events when there are none yet'
+)
 
-shopcart_parser = api.parser()
-shopcart_parser.add_argument('id', type=int)
-shopcart_parser.add_argument('products', type=list)
+batch_operation_model = api.model(
+    "BatchOperation",
+    {
+        "method": fields.String(
+            required=True,
+            enum=["GET", "POST", "PUT", "DELETE"],
+            description="The HTTP method of the operation",
+        ),
+        "path": fields.String(
+            required=True, description="The path of the operation below /api, e.g. /shopcarts/1"
+        ),
+        "body": fields.Raw(description="The JSON body of the operation"),
+    },
+)
+batch_model = api.model(
+    "Batch",
+    {
+        "operations": fields.List(
+            fields.Nested(batch_operation_model),
+            required=True,
+            description="The operations to run in order",
+        ),
+    },
+)
 
 ######################################################################
 #  PATH: /shopcarts/{id}
@@ -96,6 +204,7 @@ class ShopCartResource(Resource):
     ShopCartResource class
     Allows the manipulation of a single Shop Cart
     GET /shopcart{id} - Returns a Shop Cart with the id
+    HEAD /shopcart{id} - Checks that a Shop Cart with the id exists
     PUT /shopcart{id} - Update a Shop Cart with the id
     DELETE /shopcart{id} -  Deletes a Shop Cart with the id
     POST /shopcart{id} -  Create a Shop Cart with the id
@@ -121,20 +230,39 @@ class ShopCartResource(Resource):
             )
         return shopcart.serialize(), status.HTTP_200_OK
 
+    # ------------------------------------------------------------------
+    # CHECK THAT A Shop Cart EXISTS
+    # ------------------------------------------------------------------
+    @api.doc("check_shopcarts")
+    @api.response(404, "Shop Cart not found")
+    def head(self, id):
+        """
+        Check that a Shop Cart exists
+        This endpoint answers like GET without a body, but never loads the
+        Shop Cart or its products
+        """
+        app.logger.info("Request to Check a shop cart with id [%s]", id)
+        if not Shopcart.exists(id):
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                "Shop Cart with id '{}' was not found.".format(id),
+            )
+        return "", status.HTTP_200_OK
+
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING Shop Cart
     # ------------------------------------------------------------------
     @api.doc("update_shopcarts")
     @api.response(404, "Shop Cart not found")
     @api.response(400, "The posted Shop Cart data was not valid")
-    @api.expect(shopcart_parser, validate=True)
+    @api.expect(shopcart_model)
     @api.marshal_with(shopcart_model)
     def put(self, id):
         """
         Update a Shop Cart
         This endpoint will update a Shop Cart based the body that is posted
         """
-        shopcart_parser.parse_args()
+        data = shopcart_body(api.payload)
         app.logger.info("Request to Update a Shop Cart with id [%s]", id)
         shopcart = Shopcart.find_by_id(id)
         if not shopcart:
@@ -143,9 +271,8 @@ class ShopCartResource(Resource):
                 "Shop Cart with id '{}' was not found.".format(id),
             )
         app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
-        shopcart.deserialize(data)
-        shopcart.id = id
+        # only the products that differ are written, all in one transaction
+        shopcart.deserialize(dict(data, id=shopcart.id))
         shopcart.update()
         return shopcart.serialize(), status.HTTP_200_OK
 
@@ -169,30 +296,40 @@ class ShopCartResource(Resource):
     # ------------------------------------------------------------------
     # Create A NEW Shop Cart
     # ------------------------------------------------------------------
+    @idempotent
     @api.doc("create_shopcarts")
+    @api.response(200, "Shop Cart already existed and upsert replaced its products")
     @api.response(400, "The posted data was not valid")
     @api.response(409, "Shop Cart already exists")
-    @api.expect(shopcart_parser, validate=True)
+    @api.expect(shopcart_model, shopcart_create_args)
     @api.marshal_with(shopcart_model, code=201)
     def post(self, id):
         """
         Creates a Shop Cart
-        This endpoint will create a Shop Cart based the data in the body that is posted
+        This endpoint will create a Shop Cart based the data in the body that is posted.
+        With ?upsert=true an existing Shop Cart gets the posted products instead of a 409.
         """
-        shopcart_parser.parse_args()
+        data = shopcart_body(api.payload)
+        upsert = shopcart_create_args.parse_args()["upsert"]
         app.logger.info("Request to Create a Shop Cart")
+        logging.info("To create shopcart with id: %s", id)
         shopcart = Shopcart()
         app.logger.debug("Payload = %s", api.payload)
-        shopcart.deserialize(api.payload)
-        found_shop_cart = Shopcart.find_by_id(id)
-        logging.info("To create shopcart with id: %d", shopcart.id)
-        if found_shop_cart is not None:
-            logging.info("Found shopcart: %s", type(found_shop_cart))
-            abort(status.HTTP_409_CONFLICT, f"Shopcart {shopcart.id} already exists")
-        shopcart.create(id)
-        app.logger.info("shopcart with new id [%s] created!", id)
+        shopcart.deserialize(data)
+        # the insert itself tells if the cart exists, even when a concurrent request created it
+        if shopcart.create(id):
+            app.logger.info("shopcart with new id [%s] created!", id)
+            location_url = api.url_for(ShopCartResource, id=shopcart.id, _external=True)
+            return shopcart.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        if not upsert:
+            abort(status.HTTP_409_CONFLICT, f"Shopcart {id} already exists")
+        # the existing cart gets the posted products like a PUT, in the same transaction
+        shopcart = Shopcart.find_by_id(id)
+        shopcart.deserialize(dict(data, id=shopcart.id))
+        shopcart.update()
+        app.logger.info("shopcart with id [%s] replaced", id)
         location_url = api.url_for(ShopCartResource, id=shopcart.id, _external=True)
-        return shopcart.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        return shopcart.serialize(), status.HTTP_200_OK, {"Location": location_url}
 
 
 ######################################################################
@@ -307,7 +444,7 @@ class ProductResource(Resource):
             product_id,
             id,
         )
-        product = Product.find(product_id)
+        product = Product.find_in_cart(id, product_id)
         if not product:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -330,7 +467,7 @@ class ProductResource(Resource):
             product_id,
             id,
         )
-        product = Product.find(product_id)
+        product = Product.find_in_cart(id, product_id)
         if product:
             product.delete()
             app.logger.info("Product with id [%s] was deleted", product_id)
@@ -342,28 +479,29 @@ class ProductResource(Resource):
     @api.doc("update_products")
     @api.response(404, "Product not found")
     @api.response(400, "The posted Product data was not valid")
-    @api.expect(product_parser, validate=True)
+    @api.expect(product_model)
     @api.marshal_with(product_model)
     def put(self, id, product_id):
         """
         Update a Product
         This endpoint will update a Product based the body that is posted
         """
-        args = product_parser.parse_args()
+        data = product_body(api.payload)
         app.logger.info(
             "Request to Update a Product with id [%s] for customer with id [%s]",
             product_id,
             id,
         )
-        product = Product.find(product_id)
+        product = Product.find_in_cart(id, product_id)
         if not product:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 "Product with id '{}' was not found.".format(product_id),
             )
         app.logger.debug("Payload = %s", api.payload)
-        # data = api.payload
-        product.deserialize(args)
+        if data["shopcart_id"] is None:
+            data["shopcart_id"] = product.shopcart_id
+        product.deserialize(data)
         product.id = product_id
         product.update()
         return product.serialize(), status.HTTP_200_OK
@@ -397,17 +535,18 @@ class ProductOperation(Resource):
     # ------------------------------------------------------------------
     # Add A NEW Product to the shopcart
     # ------------------------------------------------------------------
+    @idempotent
     @api.doc("add_products")
     @api.response(400, "The posted data was not valid")
     @api.response(404, "Product not found")
-    @api.expect(product_parser, validate=True)
+    @api.expect(product_model)
     @api.marshal_with(product_model, code=201)
     def post(self, id):
         """
         Creates a Product
         This endpoint will create a Product and add it to the shopcart based the data in the body that is posted
         """
-        product_parser.parse_args()
+        data = product_body(api.payload)
         app.logger.info("Request to Create a Product")
         shopcart = Shopcart().find_by_id(id)
         if not shopcart:
@@ -417,7 +556,6 @@ class ProductOperation(Resource):
             )
         product = Product()
         app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
         product.deserialize(data)
         shopcart.products.append(product)
         shopcart.update()
@@ -553,20 +691,14 @@ class ShopcartCollection(Resource):
     # LIST ALL Shop carts
     # ------------------------------------------------------------------
     @api.doc("list_shopcarts")
+    @api.expect(shopcart_args)
     @api.marshal_list_with(shopcart_model)
     def get(self):
         """Returns all of the Shopcarts"""
         app.logger.info("Request for Shop Cart list")
-        id = request.args.get("id")
-        name = request.args.get("name")
-        results = []
-        if name:
-            app.logger.info("Request to Retrieve a shop cart with id [%s]", id)
-            shopcarts = Shopcart.filter_by_product_name(name)
-            results = [shopcart.serialize() for shopcart in shopcarts]
-        else:
-            shopcarts = Shopcart.all()
-            results = [shopcart.serialize() for shopcart in shopcarts]
+        args = shopcart_args.parse_args()
+        shopcarts = Shopcart.find_by_filters(args)
+        results = [shopcart.serialize() for shopcart in shopcarts]
         return results, status.HTTP_200_OK
 
 
@@ -599,7 +731,7 @@ class ShopcartAction(Resource):
     @api.doc("update_shopcarts")
     @api.response(404, "Shop Cart not found")
     @api.response(400, "The posted Shop Cart data was not valid")
-    @api.expect(shopcart_parser, validate=True)
+    @api.expect(shopcart_model)
     @api.marshal_with(shopcart_model)
     def put(self, id):
         """
@@ -607,21 +739,277 @@ class ShopcartAction(Resource):
         This endpoint will update a Shop Cart based the body that is posted
         """
         app.logger.info("Request to Update a Shop Cart with id [%s]", id)
-        shopcart_parser.parse_args()
+        shopcart_body(api.payload)
         shopcart = Shopcart.find_by_id(id)
         if not shopcart:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 "Shop Cart with id '{}' was not found.".format(id),
             )
-        for product in shopcart.products:
-            product.delete()
-        shopcart.products = []
-        shopcart.id = id
-        shopcart.update()
+        shopcart.clear()
         return shopcart.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /shopcarts/{id}/merge
+######################################################################
+merge_args = api.parser()
+merge_args.add_argument(
+    'from', type=int, required=True, location='args', help='The shop cart to merge in and delete'
+)
+
+
+@api.route("/shopcarts/<int:id>/merge")
+@api.param("id", "The shop cart identifier")
+class ShopcartMerge(Resource):
+    # ------------------------------------------------------------------
+    # merge another shopcart into this one
+    # ------------------------------------------------------------------
+    @idempotent
+    @api.doc("merge_shopcarts")
+    @api.response(400, "A Shop Cart cannot be merged into itself")
+    @api.response(404, "The Shop Cart to merge in was not found")
+    @api.expect(merge_args)
+    @api.marshal_with(shopcart_model)
+    def post(self, id):
+        """
+        Merge a Shop Cart into this one
+        This endpoint will move the products of the ?from= Shop Cart into
+        this one and delete it, in one transaction. Products with the same
+        name are combined by adding up their quantities. This Shop Cart is
+        created when it does not exist yet, e.g. when a guest logs in.
+        """
+        from_id = merge_args.parse_args()["from"]
+        app.logger.info("Request to Merge Shop Cart [%s] into [%s]", from_id, id)
+        shopcart = Shopcart.merge(id, from_id)
+        if not shopcart:
+            abort(status.HTTP_404_NOT_FOUND, "Shop Cart with id '{}' was not found.".format(from_id))
+        return shopcart.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{id}/snapshots
+######################################################################
+snapshot_values_model = api.model(
+    "SnapshotValues",
+    {
+        "quantity": fields.Integer(description="The quantity of the product"),
+        "price": fields.Float(description="The price of the product"),
+    },
+)
+snapshot_line_model = api.inherit(
+    "SnapshotLine",
+    snapshot_values_model,
+    {
+        "name": fields.String(description="The name of the product"),
+    },
+)
+snapshot_model = api.model(
+    "Snapshot",
+    {
+        "id": fields.Integer(readonly=True, description="The id of the snapshot"),
+        "shopcart_id": fields.Integer(readonly=True, description="The shop cart it was taken of"),
+        "name": fields.String(description="An optional label, e.g. 'birthday party'"),
+        "line_count": fields.Integer(readonly=True, description="The number of products it holds"),
+        "created_at": fields.String(readonly=True, description="When it was taken"),
+        "products": fields.List(fields.Nested(snapshot_line_model), description="The saved products"),
+    },
+)
+snapshot_change_model = api.model(
+    "SnapshotChange",
+    {
+        "name": fields.String(description="The name of the product"),
+        "old": fields.Nested(snapshot_values_model, description="The quantity and price in the snapshot"),
+        "new": fields.Nested(snapshot_values_model, description="The quantity and price compared with"),
+    },
+)
+snapshot_diff_model = api.model(
+    "SnapshotDiff",
+    {
+        "added": fields.List(fields.Nested(snapshot_line_model), description="Products that are new since"),
+        "removed": fields.List(fields.Nested(snapshot_line_model), description="Products that are gone since"),
+        "changed": fields.List(fields.Nested(snapshot_change_model), description="Products whose quantity or price changed"),
+    },
+)
+snapshot_diff_args = api.parser()
+snapshot_diff_args.add_argument(
+    'against', type=int, location='args', help='Compare with this snapshot instead of the shop cart'
+)
+
+
+def find_snapshot_or_404(id, snapshot_id):
+    """Returns a snapshot of a shop cart, aborts with a 404 when there is none"""
+    snapshot = CartSnapshot.find_for(id, snapshot_id)
+    if not snapshot:
+        abort(status.HTTP_404_NOT_FOUND, "Snapshot with id '{}' was not found.".format(snapshot_id))
+    return snapshot
+
+
+@api.route("/shopcarts/<id>/snapshots")
+@api.param("id", "The shop cart identifier")
+class SnapshotCollection(Resource):
+    # ------------------------------------------------------------------
+    # LIST THE SNAPSHOTS OF A SHOP CART
+    # ------------------------------------------------------------------
+    @api.doc("list_snapshots")
+    @api.marshal_list_with(snapshot_model, skip_none=True)
+    def get(self, id):
+        """Returns the snapshots of a Shop Cart, newest first, without their products"""
+        app.logger.info("Request to list the Snapshots of Shop Cart [%s]", id)
+        return [snapshot.serialize() for snapshot in CartSnapshot.all_for(id)], status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # SAVE A SHOP CART
+    # ------------------------------------------------------------------
+    @api.doc("create_snapshots")
+    @api.response(404, "Shop Cart not found")
+    @api.expect(snapshot_model)
+    @api.marshal_with(snapshot_model, code=201)
+    def post(self, id):
+        """
+        Save a Shop Cart
+        This endpoint will save the products of the Shop Cart as a new
+        snapshot, which can be restored or compared later
+        """
+        app.logger.info("Request to take a Snapshot of Shop Cart [%s]", id)
+        name = (request.get_json(silent=True) or {}).get("name")
+        snapshot = CartSnapshot.take(id, name)
+        if not snapshot:
+            abort(status.HTTP_404_NOT_FOUND, "Shop Cart with id '{}' was not found.".format(id))
+        location_url = api.url_for(SnapshotResource, id=id, snapshot_id=snapshot.id, _external=True)
+        return snapshot.serialize(lines=True), status.HTTP_201_CREATED, {"Location": location_url}
+
+
+@api.route("/shopcarts/<id>/snapshots/<snapshot_id>")
+@api.param("id", "The shop cart identifier")
+@api.param("snapshot_id", "The snapshot identifier")
+class SnapshotResource(Resource):
+    # ------------------------------------------------------------------
+    # RETRIEVE A SNAPSHOT
+    # ------------------------------------------------------------------
+    @api.doc("get_snapshots")
+    @api.response(404, "Snapshot not found")
+    @api.marshal_with(snapshot_model)
+    def get(self, id, snapshot_id):
+        """Returns a snapshot of a Shop Cart with its products"""
+        app.logger.info("Request to Retrieve Snapshot [%s] of Shop Cart [%s]", snapshot_id, id)
+        return find_snapshot_or_404(id, snapshot_id).serialize(lines=True), status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # DELETE A SNAPSHOT
+    # ------------------------------------------------------------------
+    @api.doc("delete_snapshots")
+    @api.response(204, "Snapshot deleted")
+    def delete(self, id, snapshot_id):
+        """Deletes a snapshot of a Shop Cart"""
+        app.logger.info("Request to Delete Snapshot [%s] of Shop Cart [%s]", snapshot_id, id)
+        snapshot = CartSnapshot.find_for(id, snapshot_id)
+        if snapshot:
+            db.session.delete(snapshot)
+            db.session.commit()
+        return "", status.HTTP_204_NO_CONTENT
+
+
+@api.route("/shopcarts/<id>/snapshots/<snapshot_id>/restore")
+@api.param("id", "The shop cart identifier")
+@api.param("snapshot_id", "The snapshot identifier")
+class SnapshotRestore(Resource):
+    # ------------------------------------------------------------------
+    # RESTORE A SNAPSHOT
+    # ------------------------------------------------------------------
+    @api.doc("restore_snapshots")
+    @api.response(404, "Snapshot not found")
+    @api.marshal_with(shopcart_model)
+    def post(self, id, snapshot_id):
+        """
+        Restore a snapshot
+        This endpoint will replace the products of the Shop Cart with the
+        saved ones, creating the Shop Cart again if it was deleted
+        """
+        app.logger.info("Request to Restore Snapshot [%s] of Shop Cart [%s]", snapshot_id, id)
+        shopcart = find_snapshot_or_404(id, snapshot_id).restore()
+        return shopcart.serialize(), status.HTTP_200_OK
+
+
+@api.route("/shopcarts/<id>/snapshots/<snapshot_id>/diff")
+@api.param("id", "The shop cart identifier")
+@api.param("snapshot_id", "The snapshot identifier")
+class SnapshotDiff(Resource):
+    # ------------------------------------------------------------------
+    # COMPARE A SNAPSHOT
+    # ------------------------------------------------------------------
+    @api.doc("diff_snapshots")
+    @api.response(404, "Snapshot not found")
+    @api.expect(snapshot_diff_args)
+    @api.marshal_with(snapshot_diff_model)
+    def get(self, id, snapshot_id):
+        """
+        Compare a snapshot
+        This endpoint will return the products that were added, removed or
+        changed in the Shop Cart since the snapshot, or in the ?against=
+        snapshot when one is given
+        """
+        against = snapshot_diff_args.parse_args()["against"]
+        app.logger.info("Request to Compare Snapshot [%s] of Shop Cart [%s]", snapshot_id, id)
+        snapshot = find_snapshot_or_404(id, snapshot_id)
+        if against is None:
+            lines = CartSnapshot.current_lines(id)
+        else:
+            lines = find_snapshot_or_404(id, against).lines
+        return snapshot.diff(lines), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{id}/stream
+######################################################################
+
+
+@api.route("/shopcarts/<id>/stream")
+@api.param("id", "The shop cart identifier")
+class ShopcartStream(Resource):
+    # ------------------------------------------------------------------
+    # stream the changes to a shopcart
+    # ------------------------------------------------------------------
+    @api.doc("stream_shopcart", produces=["text/event-stream"])
+    @api.response(404, "Shop Cart not found")
+    def get(self, id):
+        """
+        Stream the changes to a Shop Cart
+        This endpoint keeps the connection open and sends a Server-Sent
+        "change" event whenever the Shop Cart or its products change, so
+        clients can re-read the cart instead of polling it. A "resync" event
+        means notifications were dropped and the cart should be re-read.
+        """
+        app.logger.info("Request to Stream the changes to shop cart [%s]", id)
+        shopcart = Shopcart.find_by_id(id)
+        if not shopcart:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                "Shop Cart with id '{}' was not found.".format(id),
+            )
+        watch_cart_changes()
+        subscription = cart_changes.subscribe(shopcart.id, app.config["STREAM_QUEUE_SIZE"])
+        keepalive = app.config["STREAM_KEEPALIVE"]
+
+        def events():
+            with subscription:
+                yield "retry: 3000\n\n"
+                while True:
+                    message = subscription.get(timeout=keepalive)
+                    if message is None:
+                        yield ": keepalive\n\n"
+                    elif message is RESYNC:
+                        yield "event: resync\ndata: {}\n\n"
+                    else:
+                        yield "event: change\ndata: {}\n\n".format(json.dumps(message))
+
+        response = Response(events(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"  # keep proxies from buffering the stream
+        response.call_on_close(subscription.close)  # also when the stream never started
+        return response
+
+
 '''
 @app.route("/shopcarts/<int:id>/clear", methods=["PUT"])
 def clear_shopcarts(id):
@@ -684,6 +1072,436 @@ def filter_shopcarts_by_product_name(product_name):
     return make_response(jsonify(results), status.HTTP_200_OK)
 '''
 
+######################################################################
+#  PATH: /products
+######################################################################
+
+MAX_PER_PAGE = 100
+
+
+@api.route("/products")
+class ProductSearch(Resource):
+    # ------------------------------------------------------------------
+    # Search products by name
+    # ------------------------------------------------------------------
+    @api.doc("search_products")
+    @api.response(400, "The search parameters were not valid")
+    @api.expect(product_search_args)
+    @api.marshal_list_with(product_model)
+    def get(self):
+        """
+        Search Products by name
+        This endpoint will return one page of the products whose name
+        matches exactly, case-insensitively, by prefix or fuzzily
+        """
+        args = product_search_args.parse_args()
+        if args["page"] < 1 or not 1 <= args["per_page"] <= MAX_PER_PAGE:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "page must be at least 1 and per_page between 1 and {}".format(MAX_PER_PAGE),
+            )
+        app.logger.info("Request to search Products for [%s]", args["name"])
+        products = Product.search_by_name(
+            args["name"], args["match"], args["page"], args["per_page"]
+        )
+        return [product.serialize() for product in products], status.HTTP_200_OK
+
+
+reprice_model = api.model(
+    "Reprice",
+    {
+        "price": fields.Float(required=True, description="The new price of the products"),
+        "name": fields.String(description="Reprice the products with this name"),
+        "ids": fields.List(fields.Integer, description="Reprice the products with these ids instead"),
+        "batch": fields.Integer(min=1, description="The number of products changed per transaction"),
+    },
+)
+reprice_body = Validator(reprice_model)
+reprice_result_model = api.model(
+    "RepriceResult",
+    {
+        "products": fields.Integer(description="The number of products whose price changed"),
+        "shopcarts": fields.Integer(description="The number of shop carts that hold them"),
+        "batches": fields.Integer(description="The number of transactions it took"),
+    },
+)
+
+
+@api.route("/products/reprice")
+class ProductReprice(Resource):
+    # ------------------------------------------------------------------
+    # Change the price of a product in every shopcart
+    # ------------------------------------------------------------------
+    @api.doc("reprice_products")
+    @api.response(400, "The posted reprice was not valid")
+    @api.expect(reprice_model)
+    @api.marshal_with(reprice_result_model)
+    def post(self):
+        """
+        Reprice Products
+        This endpoint will set the price of every product with the name, or
+        with one of the ids, in every Shop Cart, with one UPDATE per batch
+        """
+        check_content_type("application/json")
+        data = reprice_body(api.payload)
+        app.logger.info("Request to Reprice Products %s", data["name"] or data["ids"])
+        batch = data["batch"] or app.config["REPRICE_BATCH_SIZE"]
+        totals = Product.reprice(data["price"], data["name"], data["ids"], batch)
+        return totals, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /events
+######################################################################
+
+
+@api.route("/events")
+class EventFeed(Resource):
+    # ------------------------------------------------------------------
+    # Read the changes after a cursor
+    # ------------------------------------------------------------------
+    @api.doc("list_events")
+    @api.response(400, "The feed parameters were not valid")
+    @api.response(410, "The events after the cursor were purged")
+    @api.expect(event_args)
+    @api.marshal_with(event_feed_model)
+    def get(self):
+        """
+        Returns the changes to the Shop Carts
+        This endpoint will return the events after the since cursor, oldest
+        first. When there are none yet it waits up to wait seconds for new
+        ones, so consumers can long-poll instead of re-reading every cart.
+        """
+        args = event_args.parse_args()
+        if not 1 <= args["limit"] <= MAX_PER_PAGE:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and {}".format(MAX_PER_PAGE))
+        if CartEvent.purged_after(args["since"]):
+            abort(
+                status.HTTP_410_GONE,
+                "The events after {} were purged, re-read the Shop Carts and start from the cursor 0".format(
+                    args["since"]
+                ),
+            )
+        wait = min(max(args["wait"], 0), app.config["EVENTS_MAX_WAIT"])
+        deadline = time.monotonic() + wait
+        events = CartEvent.since(args["since"], args["limit"])
+        while not events and time.monotonic() < deadline:
+            time.sleep(app.config["EVENTS_POLL_INTERVAL"])
+            db.session.rollback()  # end the snapshot so new commits are visible
+            events = CartEvent.since(args["since"], args["limit"])
+        cursor = events[-1].position if events else args["since"]
+        return {"events": [event.serialize() for event in events], "cursor": cursor}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{id}/quote and /quotes
+######################################################################
+quote_request_model = api.model(
+    "QuoteRequest",
+    {
+        "rules": fields.List(
+            fields.Raw, description="The promotion rules, in order: percent, fixed or bogo"
+        ),
+        "tax_rate": fields.Float(description="The tax as a percentage of the discounted subtotal"),
+    },
+)
+batch_quote_request_model = api.inherit(
+    "BatchQuoteRequest",
+    quote_request_model,
+    {
+        "ids": fields.List(fields.Integer, required=True, description="The shop carts to quote"),
+    },
+)
+quote_line_model = api.model(
+    "QuoteLine",
+    {
+        "product_id": fields.Integer(description="The product of the line"),
+        "name": fields.String(description="The name of the product"),
+        "quantity": fields.Integer(description="The quantity of the product"),
+        "price": fields.Float(description="The price of one unit"),
+        "subtotal": fields.Float(description="The price of the line before discounts"),
+        "discount": fields.Float(description="What the rules took off the line"),
+        "total": fields.Float(description="The price of the line after discounts"),
+    },
+)
+quote_model = api.model(
+    "Quote",
+    {
+        "shopcart_id": fields.Integer(description="The quoted shop cart"),
+        "subtotal": fields.Float(description="The price of the cart before discounts"),
+        "discount": fields.Float(description="What the rules took off the cart"),
+        "tax": fields.Float(description="The tax on the discounted subtotal"),
+        "total": fields.Float(description="What the cart costs"),
+        "lines": fields.List(fields.Nested(quote_line_model), description="The lines, for a single cart"),
+    },
+)
+
+
+def pricing_arguments(payload):
+    """Returns the rules and tax rate of a quote request, aborts with a 400 when they are not valid"""
+    try:
+        rules = pricing.parse_rules(payload.get("rules"))
+        tax_rate = payload.get("tax_rate") or 0
+        pricing.parts_per_million(tax_rate, "tax rate")
+    except ValueError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+    return rules, tax_rate
+
+
+@api.route("/shopcarts/<int:id>/quote")
+@api.param("id", "The Shop Cart identifier")
+class ShopcartQuote(Resource):
+    # ------------------------------------------------------------------
+    # Price a shopcart
+    # ------------------------------------------------------------------
+    @api.doc("quote_shopcart")
+    @api.response(400, "The pricing rules were not valid")
+    @api.response(404, "Shopcart not found")
+    @api.expect(quote_request_model)
+    @api.marshal_with(quote_model, skip_none=True)
+    def post(self, id):
+        """
+        Price a Shop Cart
+        This endpoint will apply the posted promotion rules and tax rate to
+        the Shop Cart and return its totals and the price of every line
+        """
+        check_content_type("application/json")
+        rules, tax_rate = pricing_arguments(api.payload or {})
+        app.logger.info("Request to Quote Shopcart %s with %d rules", id, len(rules))
+        if not Shopcart.exists(id):
+            abort(status.HTTP_404_NOT_FOUND, "Shopcart with id '{}' was not found.".format(id))
+        lines = pricing.CartLines(Product.line_rows([id]))
+        quote = pricing.quote_carts([id], lines, rules, tax_rate, detail=True)[0]
+        return quote, status.HTTP_200_OK
+
+
+@api.route("/quotes")
+class BatchQuote(Resource):
+    # ------------------------------------------------------------------
+    # Price many shopcarts at once
+    # ------------------------------------------------------------------
+    @api.doc("quote_shopcarts")
+    @api.response(400, "The posted ids or pricing rules were not valid")
+    @api.expect(batch_quote_request_model)
+    @api.marshal_list_with(quote_model, skip_none=True)
+    def post(self):
+        """
+        Price many Shop Carts
+        This endpoint will apply the posted promotion rules and tax rate to
+        every Shop Cart in ids with one query for all of their products, and
+        return the totals of each cart that exists, in id order
+        """
+        check_content_type("application/json")
+        payload = api.payload or {}
+        ids = payload.get("ids")
+        if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+            abort(status.HTTP_400_BAD_REQUEST, "A batch quote needs a list of shop cart ids")
+        if len(ids) > app.config["QUOTE_MAX_CARTS"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "A batch quote can have at most {} shop carts".format(app.config["QUOTE_MAX_CARTS"]),
+            )
+        rules, tax_rate = pricing_arguments(payload)
+        app.logger.info("Request to Quote %d Shopcarts with %d rules", len(ids), len(rules))
+        found = sorted(Shopcart.existing_ids(ids))
+        lines = pricing.CartLines(Product.line_rows(found))
+        return pricing.quote_carts(found, lines, rules, tax_rate), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /admin/reset
+######################################################################
+fixture_model = api.model(
+    "Fixture",
+    {
+        "shopcarts": fields.List(
+            fields.Nested(shopcart_model), required=True, description="The shop carts to load, with product ids"
+        ),
+    },
+)
+reset_model = api.model(
+    "ResetResult",
+    {
+        "shopcarts": fields.Integer(description="The number of shop carts loaded"),
+        "products": fields.Integer(description="The number of products loaded"),
+    },
+)
+
+# the header that carries ADMIN_RESET_TOKEN
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+@api.route("/admin/reset")
+class AdminReset(Resource):
+    # ------------------------------------------------------------------
+    # replace every shopcart with a fixture
+    # ------------------------------------------------------------------
+    @api.doc("reset_shopcarts")
+    @api.response(400, "The fixture was not valid")
+    @api.response(403, "Resets are not enabled, or the admin token is wrong")
+    @api.expect(fixture_model)
+    @api.marshal_with(reset_model)
+    def put(self):
+        """
+        Replace every Shop Cart with a fixture
+        This endpoint deletes every Shop Cart and Product and bulk loads the
+        posted ones in the same transaction, so a test environment is reset
+        in constant time. It only works when ADMIN_RESET_ENABLED is set, and
+        with the ADMIN_RESET_TOKEN in the X-Admin-Token header when there is
+        one. The change feed is replaced with a single shopcarts.reset event.
+        """
+        if not app.config["ADMIN_RESET_ENABLED"]:
+            abort(status.HTTP_403_FORBIDDEN, "Resets are not enabled on this service")
+        token = app.config["ADMIN_RESET_TOKEN"]
+        if token and not hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ""), token):
+            abort(status.HTTP_403_FORBIDDEN, "Resets need the admin token in the {} header".format(ADMIN_TOKEN_HEADER))
+        check_content_type("application/json")
+        try:
+            carts = [transfer.cart_from_record(record) for record in api.payload["shopcarts"]]
+        except (KeyError, TypeError, ValueError) as error:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid fixture: {!r}".format(error))
+        app.logger.info("Request to Reset the shop carts to %d carts", len(carts))
+        connection = db.session.connection()
+        transfer.truncate_carts(connection)
+        try:
+            shopcarts, products = transfer.load_carts(connection, carts)
+        except IntegrityError as error:
+            db.session.rollback()
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid fixture: {}".format(error.orig))
+        transfer.reset_product_sequence(connection)
+        CartEvent.reset(db.session)
+        db.session.commit()
+        return {"shopcarts": shopcarts, "products": products}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /batch
+######################################################################
+
+
+@api.route("/batch")
+class BatchResource(Resource):
+    # ------------------------------------------------------------------
+    # Run several operations in one transaction
+    # ------------------------------------------------------------------
+    @api.doc("batch_operations")
+    @api.response(400, "The posted batch was not valid")
+    @api.expect(batch_model)
+    def post(self):
+        """
+        Runs a batch of operations
+        This endpoint will run each operation against the other endpoints in
+        order, inside one database transaction, and return the status and
+        body of every operation. An operation that fails is rolled back on
+        its own and does not stop the ones after it.
+        """
+        operations = (api.payload or {}).get("operations")
+        if not isinstance(operations, list):
+            abort(status.HTTP_400_BAD_REQUEST, "A batch needs a list of operations")
+        if len(operations) > app.config["BATCH_MAX_OPERATIONS"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "A batch can have at most {} operations".format(app.config["BATCH_MAX_OPERATIONS"]),
+            )
+        app.logger.info("Request to run a batch of %d operations", len(operations))
+        db.session.info["defer_commit"] = True
+        try:
+            results = [run_batch_operation(operation) for operation in operations]
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.info.pop("defer_commit", None)
+        db.session.commit()
+        return {"results": results}, status.HTTP_200_OK
+
+
+BATCH_METHODS = ("GET", "POST", "PUT", "DELETE")
+
+
+def batch_error(method, path):
+    """Returns why an operation cannot run in a batch, or None"""
+    url = urlsplit(path)
+    if method not in BATCH_METHODS or not path.startswith("/") or url.path.startswith("/batch"):
+        return "Invalid operation {} {}".format(method, path)
+    # waiting for other transactions to commit cannot work inside this one
+    if url.path.startswith("/events") or url.path.endswith("/stream") or "wait" in parse_qs(url.query):
+        return "{} {} waits for changes and cannot run in a batch".format(method, path)
+    return None
+
+
+def run_batch_operation(operation):
+    """Dispatches one operation of a batch inside a savepoint"""
+    method = str(operation.get("method", "")).upper()
+    path = str(operation.get("path", ""))
+    error = batch_error(method, path)
+    if error:
+        return {"status": status.HTTP_400_BAD_REQUEST, "body": {"message": error}}
+    builder = EnvironBuilder(
+        path=api.prefix + path,
+        method=method,
+        json=operation.get("body"),
+        base_url=request.host_url,
+    )
+    # a rollback in the operation only goes back to this savepoint, see RoutingSession
+    db.session.info["batch_savepoint"] = db.session.begin_nested()
+    try:
+        with app.request_context(builder.get_environ()):
+            response = app.full_dispatch_request()
+    finally:
+        savepoint = db.session.info.pop("batch_savepoint")
+    if savepoint.is_active:
+        if response.status_code < 400:
+            savepoint.commit()
+        else:
+            savepoint.rollback()
+    return {"status": response.status_code, "body": response.get_json(silent=True)}
+
+
+######################################################################
+#  R E A D   R E P L I C A   R O U T I N G
+######################################################################
+
+READ_ONLY_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def replica_configured():
+    """Returns True when a read replica bind is configured"""
+    return REPLICA_BIND in (app.config.get("SQLALCHEMY_BINDS") or {})
+
+
+@app.before_request
+def route_reads_to_replica():
+    """Sends the queries of read-only requests to the replica"""
+    if request.method not in READ_ONLY_METHODS or not replica_configured():
+        return
+    # a batch must see its own uncommitted writes
+    if db.session.info.get("defer_commit"):
+        return
+    # read your own writes: stay on the primary for a while after a mutation
+    since_last_write = time.time() - session.get("last_write", 0)
+    if since_last_write > app.config["REPLICA_READ_YOUR_WRITES"]:
+        db.session.info["read_only"] = True
+
+
+@app.after_request
+def remember_last_write(response):
+    """Records when a client last changed something"""
+    if (
+        request.method not in READ_ONLY_METHODS
+        and response.status_code < 400
+        and replica_configured()
+    ):
+        session["last_write"] = time.time()
+    return response
+
+
+@app.teardown_request
+def reset_replica_routing(exception):
+    """Makes sure the next request starts out on the primary"""
+    db.session.info.pop("read_only", None)
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
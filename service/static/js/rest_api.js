@@ -29,6 +29,42 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Shows a list of products in the results table
+    function render_products(res) {
+        $("#search_results").empty();
+        let table = '<table class="table table-striped" cellpadding="10">'
+        table += '<thead><tr>'
+        table += '<th class="col-md-2">ID</th>'
+        table += '<th class="col-md-2">Name</th>'
+        table += '<th class="col-md-2">Quantity</th>'
+        table += '<th class="col-md-2">Price</th>'
+        table += '</tr></thead><tbody>'
+        for(let i = 0; i < res.length; i++) {
+            let product = res[i];
+            table +=  `<tr id="row_${i}"><td>${product.id}</td><td>${product.name}</td><td>${product.quantity}</td><td>${product.price}</td></tr>`;
+        }
+        table += '</tbody></table>';
+        $("#search_results").append(table);
+    }
+
+    // Keeps the listed products of a shop cart up to date as it changes,
+    // instead of polling it
+    let cart_stream = null;
+    function watch_shopcart(customer_id) {
+        if (!window.EventSource) {
+            return;
+        }
+        if (cart_stream) {
+            cart_stream.close();
+        }
+        cart_stream = new EventSource(`api/shopcarts/${customer_id}/stream`);
+        let refresh = function () {
+            $.getJSON(`api/shopcarts/${customer_id}/products`, render_products);
+        };
+        cart_stream.addEventListener("change", refresh);
+        cart_stream.addEventListener("resync", refresh);
+    }
+
     // ****************************************
     // Create A Shop cart with product
     // ****************************************
@@ -109,31 +145,15 @@ $(function () {
          
         ajax.done(function(res){
             //alert(res.toSource())
-            $("#search_results").empty();
-            let table = '<table class="table table-striped" cellpadding="10">'
-            table += '<thead><tr>'
-            table += '<th class="col-md-2">ID</th>'
-            table += '<th class="col-md-2">Name</th>'
-            table += '<th class="col-md-2">Quantity</th>'
-            table += '<th class="col-md-2">Price</th>'
-            table += '</tr></thead><tbody>'
-            let firstProduct = "";
-            for(let i = 0; i < res.length; i++) {
-                let product = res[i];
-                table +=  `<tr id="row_${i}"><td>${product.id}</td><td>${product.name}</td><td>${product.quantity}</td><td>${product.price}</td></tr>`;
-                if (i == 0) {
-                    firstProduct = product;
-                }
-            }
-            table += '</tbody></table>';
-            $("#search_results").append(table);
+            render_products(res)
 
                     // copy the first result to the form
-            if (firstProduct != "") {
-                update_product_form_data(firstProduct)
+            if (res.length > 0) {
+                update_product_form_data(res[0])
             }
         
                 flash_message("Success")
+                watch_shopcart(customer_id)
             });
 
         ajax.fail(function(res){
@@ -0,0 +1,171 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Broadcasting
+
+This module fans messages out to the subscribers of a channel inside one
+process. Every subscriber has its own bounded queue, so a slow client can
+never hold up the publisher or the other subscribers: when its queue is
+full the pending messages are replaced by a single RESYNC marker that
+tells it to re-read the current state instead.
+
+NotificationListener relays Postgres NOTIFY messages into a Broadcaster,
+which is how a change made by one worker process reaches the subscribers
+of all the others.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger("flask.app")
+
+# Queued in place of the messages a subscriber was too slow to receive
+RESYNC = object()
+
+
+class Subscription:
+    """A subscriber's bounded queue of the messages on one channel"""
+
+    def __init__(self, broadcaster, channel, maxsize):
+        self.broadcaster = broadcaster
+        self.channel = channel
+        self._queue = queue.Queue(maxsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, message):
+        """Queues a message without ever blocking the publisher"""
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait(RESYNC)
+
+    def get(self, timeout=None):
+        """Returns the next message, or None when none came within the timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Stops receiving messages"""
+        self.broadcaster.unsubscribe(self)
+
+
+class Broadcaster:
+    """Publishes messages to every Subscription of a channel"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channel, maxsize=100):
+        """Returns a new Subscription to a channel"""
+        subscription = Subscription(self, channel, maxsize)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a Subscription from its channel"""
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        """Queues a message for every subscriber of a channel"""
+        with self._lock:
+            for subscription in self._subscriptions.get(channel, ()):
+                subscription.put(message)
+
+    def subscribers(self, channel):
+        """Returns the number of subscribers of a channel"""
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+class NotificationListener(threading.Thread):
+    """
+    Relays the JSON payloads of Postgres NOTIFY messages to a Broadcaster
+
+    The listener holds one connection of its own, outside the engine's
+    pool, and reconnects when it is lost. Each payload must be a JSON
+    object; key names the member that is used as the broadcast channel.
+    """
+
+    def __init__(self, engine, channel, broadcaster, key, poll_interval=1.0):
+        super().__init__(name="listen-" + channel, daemon=True)
+        self.engine = engine
+        self.channel = channel
+        self.broadcaster = broadcaster
+        self.key = key
+        self.poll_interval = poll_interval
+        self.ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Asks the listener to stop after its current poll"""
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Lost the LISTEN connection for %s, reconnecting", self.channel)
+                self.ready.clear()
+                self._stopped.wait(self.poll_interval)
+
+    def _listen(self):
+        connection = self.engine.connect()
+        connection.detach()  # a long lived connection must not hold a pool slot
+        raw = connection.connection.connection  # the DBAPI connection under the pool's proxy
+        try:
+            raw.autocommit = True
+            with raw.cursor() as cursor:
+                cursor.execute("LISTEN " + self.channel)
+            self.ready.set()
+            while not self._stopped.is_set():
+                if select.select([raw], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    self._relay(raw.notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+    def _relay(self, payload):
+        try:
+            message = json.loads(payload)
+            self.broadcaster.publish(message[self.key], message)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Ignoring a bad notification on %s: %r", self.channel, payload)
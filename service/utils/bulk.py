@@ -0,0 +1,73 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Loading
+
+Loads many rows into a table at once. Postgres gets them with a single
+COPY ... FROM STDIN, other databases with one executemany INSERT. Bulk
+loads go around the ORM, so they write no cart events.
+"""
+import csv
+import io
+from itertools import islice
+from sqlalchemy.exc import DBAPIError
+
+
+def copy_rows(connection, table, columns, rows):
+    """
+    Loads rows into a table and returns how many were loaded
+    Args:
+        connection: the SQLAlchemy Connection to load them with
+        table (Table): the table to load
+        columns (list): the names of the columns that the rows hold
+        rows (iterable): tuples of values in the order of columns
+    """
+    if connection.dialect.name != "postgresql":
+        rows = [dict(zip(columns, row)) for row in rows]
+        if rows:
+            connection.execute(table.insert(), rows)
+        return len(rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    if count:
+        buffer.seek(0)
+        preparer = connection.dialect.identifier_preparer
+        statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+            preparer.format_table(table), ", ".join(preparer.quote(column) for column in columns)
+        )
+        dbapi = connection.dialect.dbapi
+        try:
+            with connection.connection.cursor() as cursor:
+                cursor.copy_expert(statement, buffer)
+        except dbapi.Error as error:
+            # raise the same exceptions as the statements run by SQLAlchemy
+            raise DBAPIError.instance(statement, None, error, dbapi.Error) from error
+    return count
+
+
+def chunks(rows, size):
+    """Splits an iterable into lists of at most size items"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
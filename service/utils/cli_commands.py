@@ -1,20 +1,342 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
-from service.models import db
+import json
+import time
+from datetime import datetime, timedelta
+import click
+from flask_restx import reqparse
+from service import app, routes
+from service.models import (
+    db, create_tables, migrate_schema, migrate_prices, DataValidationError, Shopcart, Product, CartEvent
+)
+from service.utils import pricing, representations, transfer
+from service.utils.bulk import copy_rows, chunks
+from service.utils.seeding import CartGenerator
 
 
 ######################################################################
 # Command to force tables to be rebuilt
-# Usage: flask create-db
+# Usage: flask create-db [--partitions N]
 ######################################################################
 @app.cli.command("create-db")
-def create_db():
+@click.option(
+    "--partitions",
+    type=int,
+    default=lambda: app.config.get("PRODUCT_PARTITIONS", 0),
+    help="Hash partition the product table by shopcart id (Postgres only)",
+)
+def create_db(partitions):
     """
     Recreates a local database. You probably should not use this on
     production.
     """
     db.drop_all()
-    db.create_all()
+    create_tables(partitions)
     db.session.commit()
+
+
+######################################################################
+# Command to bring the tables of an existing database up to date
+# Usage: flask migrate-db
+######################################################################
+@app.cli.command("migrate-db")
+def migrate_db():
+    """Creates the missing tables and adds the missing columns and indexes"""
+    db.session.remove()
+    db.create_all()
+    with db.engine.begin() as connection:
+        changes = migrate_schema(connection)
+        count = migrate_prices(connection)
+    if count is not None:
+        changes.append("migrated the prices of {} products to whole cents".format(count))
+    for change in changes:
+        click.echo(change[0].upper() + change[1:])
+    if not changes:
+        click.echo("The database is up to date")
+
+
+######################################################################
+# Command to store the prices of an existing database as whole cents
+# Usage: flask migrate-prices
+######################################################################
+@app.cli.command("migrate-prices")
+def migrate_price_column():
+    """Moves product prices from the old float column to whole cents"""
+    db.session.remove()
+    with db.engine.begin() as connection:
+        count = migrate_prices(connection)
+    if count is None:
+        click.echo("Prices are already stored as whole cents")
+    else:
+        click.echo("Migrated the prices of {} products".format(count))
+
+
+######################################################################
+# Command to delete the old cart events, run it from a daily job
+# Usage: flask purge-events [--days N]
+######################################################################
+@app.cli.command("purge-events")
+@click.option(
+    "--days", type=int, default=lambda: app.config["EVENTS_RETENTION_DAYS"], help="Keep the events of this many days"
+)
+def purge_events(days):
+    """Deletes the cart events that are older than the retention period"""
+    count = CartEvent.purge(datetime.utcnow() - timedelta(days=days))
+    click.echo("Purged {} events".format(count))
+
+
+######################################################################
+# Command to fill the database with generated shop carts
+# Usage: flask seed [--carts N] [--lines N] [--names N] ...
+######################################################################
+@app.cli.command("seed")
+@click.option("--carts", type=int, default=1000, show_default=True, help="Number of shop carts to generate")
+@click.option("--lines", type=float, default=4.0, show_default=True, help="Average number of products per cart")
+@click.option("--max-lines", type=int, default=50, show_default=True, help="Most products in one cart")
+@click.option("--names", type=int, default=1000, show_default=True, help="Number of different product names")
+@click.option("--name-skew", type=float, default=1.0, show_default=True, help="Zipf exponent of name popularity")
+@click.option("--price-median", type=float, default=4.99, show_default=True, help="Median product price")
+@click.option("--price-sigma", type=float, default=1.0, show_default=True, help="Spread of the log-normal prices")
+@click.option("--batch", type=int, default=10000, show_default=True, help="Carts loaded per transaction")
+@click.option("--seed", "random_seed", type=int, default=0, show_default=True, help="Seed of the random numbers")
+def seed(carts, batch, random_seed, **distribution):
+    """
+    Fills the database with generated shop carts for performance testing.
+    The new carts get the ids after the highest existing one.
+    """
+    generator = CartGenerator(seed=random_seed, **distribution)
+    first_id = (db.session.query(db.func.max(Shopcart.id)).scalar() or 0) + 1
+    db.session.remove()
+    now = datetime.utcnow()
+    loaded_carts = loaded_products = 0
+    for chunk in chunks(generator.carts(first_id, carts), max(batch, 1)):
+        with db.engine.begin() as connection:
+            loaded_carts += copy_rows(
+                connection, Shopcart.__table__, ["id", "updated_at"],
+                ((shopcart_id, now) for shopcart_id, _ in chunk),
+            )
+            loaded_products += copy_rows(
+                connection, Product.__table__, ["name", "quantity", "price_cents", "shopcart_id"],
+                (row for _, rows in chunk for row in rows),
+            )
+        click.echo("Loaded {} carts with {} products".format(loaded_carts, loaded_products))
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect() as connection:
+            connection.execute("ANALYZE shopcart")
+            connection.execute("ANALYZE product")
+
+
+######################################################################
+# Commands to move shop carts between databases
+# Usage: flask export-carts FILE [--format csv|ndjson]
+#        flask import-carts FILE [--format csv|ndjson] [--checkpoint FILE]
+######################################################################
+@app.cli.command("export-carts")
+@click.argument("file", type=click.File("w", encoding="utf-8", lazy=True))
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), help="Defaults to the file extension")
+@click.option("--batch", type=int, default=10000, show_default=True, help="Carts read per query")
+def export_carts(file, fmt, batch):
+    """Writes every shop cart and its products to FILE ("-" for stdout)"""
+    fmt = fmt or transfer.guess_format(file.name)
+    db.session.remove()
+    with db.engine.connect() as connection:
+        count = transfer.write_carts(transfer.read_carts(connection, max(batch, 1)), file, fmt)
+    click.echo("Exported {} carts".format(count), err=True)
+
+
+@app.cli.command("import-carts")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), help="Defaults to the file extension")
+@click.option("--batch", type=int, default=10000, show_default=True, help="Carts committed per transaction")
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="Records the progress here and resumes from it, until the import is done [default: FILE.checkpoint]",
+)
+def import_carts(file, fmt, batch, checkpoint):
+    """Loads the shop carts exported to FILE ("-" for stdin)"""
+    fmt = fmt or transfer.guess_format(file.name)
+    if checkpoint is None and file.name != "<stdin>":
+        checkpoint = file.name + ".checkpoint"
+    db.session.remove()
+    carts, products = transfer.import_carts(
+        transfer.parse_carts(file, fmt),
+        max(batch, 1),
+        checkpoint,
+        lambda carts, products: click.echo("Imported {} carts with {} products".format(carts, products)),
+    )
+    click.echo("Done, imported {} carts with {} products".format(carts, products))
+
+
+######################################################################
+# Command to change the price of a product in every shop cart
+# Usage: flask reprice NAME PRICE [--batch N]
+######################################################################
+@app.cli.command("reprice")
+@click.argument("name")
+@click.argument("price", type=float)
+@click.option("--batch", type=int, default=lambda: app.config["REPRICE_BATCH_SIZE"], help="Products changed per transaction")
+def reprice(name, price, batch):
+    """Sets the price of every product called NAME to PRICE"""
+    db.session.remove()
+    try:
+        totals = Product.reprice(
+            price, name=name, batch=batch,
+            progress=lambda totals: click.echo("Repriced {products} products in {shopcarts} carts".format(**totals)),
+        )
+    except DataValidationError as error:
+        raise click.ClickException(str(error))
+    click.echo("Done, repriced {products} products in {shopcarts} carts in {batches} batches".format(**totals))
+
+
+######################################################################
+# Command to compare the pricing engine with a per-line loop
+# Usage: flask bench-pricing [--carts N] [--lines N] [--rules JSON]
+######################################################################
+BENCH_RULES = [
+    {"type": "percent", "percent": 10},
+    {"type": "fixed", "amount": 0.25, "names": ["red apple", "fresh peach", "sweet banana"]},
+    {"type": "bogo", "buy": 2, "get": 1, "names": ["organic coffee"]},
+]
+
+
+@app.cli.command("bench-pricing")
+@click.option("--carts", type=int, default=10000, show_default=True, help="Number of generated shop carts")
+@click.option("--lines", type=float, default=4.0, show_default=True, help="Average number of products per cart")
+@click.option("--names", type=int, default=1000, show_default=True, help="Number of different product names")
+@click.option("--rules", "rules_json", help="The rules as a JSON list [default: percent, fixed and bogo rules]")
+@click.option("--tax-rate", type=float, default=8.875, show_default=True, help="Tax percentage")
+@click.option("--rounds", type=int, default=5, show_default=True, help="Best of this many runs")
+def bench_pricing(carts, lines, names, rules_json, tax_rate, rounds):
+    """Times the pricing engine against a per-line loop on generated carts"""
+    rules = pricing.parse_rules(json.loads(rules_json) if rules_json else BENCH_RULES)
+    generator = CartGenerator(lines=lines, names=names)
+    rows = [
+        (shopcart_id, product_id, name, quantity, price)
+        for product_id, (name, quantity, price, shopcart_id) in enumerate(
+            (row for _, rows in generator.carts(1, carts) for row in rows), start=1
+        )
+    ]
+    ids = list(range(1, carts + 1))
+    timings = {}
+
+    def best(name, quote):
+        times = []
+        for _ in range(max(rounds, 1)):
+            start = time.perf_counter()
+            result = quote()
+            times.append(time.perf_counter() - start)
+        timings[name] = min(times)
+        return result
+
+    reference = best("per-line loop", lambda: pricing.quote_per_line(ids, rows, rules, tax_rate))
+    quotes = best("columnar", lambda: pricing.quote_carts(ids, pricing.CartLines(rows), rules, tax_rate))
+    if quotes != reference:
+        raise click.ClickException("The columnar quotes differ from the per-line loop")
+    click.echo("Priced {} carts with {} lines".format(carts, len(rows)))
+    for name, seconds in timings.items():
+        click.echo("{:>14}: {:9.1f} ms".format(name, seconds * 1000))
+    click.echo("{:>14}: {:9.1f}x".format("speedup", timings["per-line loop"] / timings["columnar"]))
+
+
+######################################################################
+# Time the response formats on a generated cart
+# Usage: flask bench-formats [--lines N] [--rounds N]
+######################################################################
+@app.cli.command("bench-formats")
+@click.option("--lines", type=int, default=10000, show_default=True, help="Number of products in the cart")
+@click.option("--names", type=int, default=1000, show_default=True, help="Number of different product names")
+@click.option("--rounds", type=int, default=5, show_default=True, help="Best of this many runs")
+def bench_formats(lines, names, rounds):
+    """Times the encoding and measures the size of every response format"""
+    generator = CartGenerator(names=names)
+    products = []
+    for product_id in range(1, lines + 1):
+        index = generator.random.randrange(len(generator.names))
+        products.append({
+            "id": product_id,
+            "shopcart_id": 1,
+            "name": generator.names[index],
+            "price": generator.prices[index] / 100,
+            "quantity": generator.quantity(),
+        })
+    payload = {"id": 1, "products": products}
+    formats = {
+        "json": lambda: representations.encode_json(payload),
+        "columnar json": lambda: representations.encode_json(representations.to_columns(payload)),
+        "msgpack": lambda: representations.encode_msgpack(payload),
+        "columnar msgpack": lambda: representations.encode_msgpack(representations.to_columns(payload)),
+    }
+    click.echo("Encoded a cart with {} products".format(lines))
+    for name, encode in formats.items():
+        times = []
+        for _ in range(max(rounds, 1)):
+            start = time.perf_counter()
+            body = encode()
+            times.append(time.perf_counter() - start)
+        click.echo("{:>16}: {:9.1f} ms {:10,d} bytes".format(name, min(times) * 1000, len(body)))
+
+
+######################################################################
+# Time the request validation against the reqparse parsers it replaced
+# Usage: flask bench-validation [--requests N] [--lines N]
+######################################################################
+def reqparse_parsers():
+    """Returns the product and shop cart parsers that the routes used to run"""
+    product_parser = reqparse.RequestParser()
+    for name, kind in (("id", int), ("name", str), ("quantity", int), ("price", float), ("shopcart_id", int)):
+        product_parser.add_argument(name, type=kind)
+    shopcart_parser = reqparse.RequestParser()
+    shopcart_parser.add_argument("id", type=int)
+    shopcart_parser.add_argument("products", type=list)
+    return product_parser, shopcart_parser
+
+
+def best_time(run, count, rounds):
+    """Returns the fastest of rounds runs of count calls"""
+    times = []
+    for _ in range(max(rounds, 1)):
+        start = time.perf_counter()
+        for _ in range(count):
+            run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@app.cli.command("bench-validation")
+@click.option("--requests", "count", type=int, default=10000, show_default=True, help="Request bodies per run")
+@click.option("--lines", type=int, default=20, show_default=True, help="Products in each shop cart body")
+@click.option("--rounds", type=int, default=5, show_default=True, help="Best of this many runs")
+def bench_validation(count, lines, rounds):
+    """Times checking and converting request bodies with reqparse and with the compiled validators"""
+    product = {"id": 1, "name": "red apple", "quantity": 2, "price": 1.99, "shopcart_id": 1}
+    shopcart = {"id": 1, "products": [dict(product, id=i) for i in range(lines)]}
+    product_parser, shopcart_parser = reqparse_parsers()
+
+    def reqparse_product():
+        Product().deserialize(product_parser.parse_args())
+
+    def compiled_product():
+        Product().deserialize(routes.product_body(product))
+
+    def reqparse_shopcart():
+        shopcart_parser.parse_args()
+        for item in shopcart["products"]:
+            Product().deserialize(item)
+
+    def compiled_shopcart():
+        for item in routes.shopcart_body(shopcart)["products"]:
+            Product().deserialize(item)
+
+    cases = (
+        ("product", product, reqparse_product, compiled_product),
+        ("shopcart", shopcart, reqparse_shopcart, compiled_shopcart),
+    )
+    click.echo("Validated {} request bodies, {} products per shop cart".format(count, lines))
+    for name, body, *paths in cases:
+        with app.test_request_context(method="POST", json=body):
+            timings = [best_time(run, count, rounds) for run in paths]
+        click.echo("{:>9}: reqparse {:8.1f} ms  compiled {:8.1f} ms  {:5.1f}x".format(
+            name, timings[0] * 1000, timings[1] * 1000, timings[0] / timings[1]
+        ))
@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module compresses large responses for the clients that accept it,
+serves the precompressed copies of the static assets that are made at
+build time (make compress-static), and stamps asset URLs with a content
+hash so browsers can cache them for a long time
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Preferred encodings first, with the suffix of their precompressed files
+ENCODINGS = (("br", ".br"), ("gzip", ".gz")) if brotli else (("gzip", ".gz"),)
+
+ASSET_URL = re.compile(r'((?:href|src)\s*=\s*")(static/[^"?]+)(")')
+
+
+def init_compression(app):
+    """Compresses responses and serves precompressed static files"""
+    app.after_request(lambda response: compress_response(app, response))
+    app.view_functions["static"] = lambda filename: send_static(app, filename)
+
+
+def accepted_encoding():
+    """Returns the best encoding the client accepts or None"""
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding, suffix
+    return None, None
+
+
+def compress(data, encoding, level=6):
+    """Compresses bytes with the given encoding"""
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_response(app, response):
+    """Compresses a response that is large enough and not streamed"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code == 204
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding, _ = accepted_encoding()
+    if encoding:
+        response.set_data(compress(data, encoding, app.config["COMPRESS_LEVEL"]))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def send_static(app, filename):
+    """Serves a static file, using its precompressed copy when there is one"""
+    encoding, suffix = accepted_encoding()
+    path = safe_join(app.static_folder, filename)
+    if encoding and path and os.path.isfile(path + suffix):
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = app.send_static_file(filename)
+    response.vary.add("Accept-Encoding")
+    version = request.args.get("v")
+    if version and version == asset_hash(app.static_folder, filename):
+        # the URL changes with the content, so it can be cached for good
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config["STATIC_MAX_AGE"]
+        response.cache_control.immutable = True
+    return response
+
+
+@lru_cache(maxsize=256)
+def asset_hash(static_folder, filename):
+    """Returns a short hash of the content of a static file"""
+    path = safe_join(static_folder, filename)
+    if not path or not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as asset:
+        for chunk in iter(lambda: asset.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+@lru_cache(maxsize=8)
+def versioned_html(static_folder, filename):
+    """Returns a static HTML page with a content hash on every asset URL"""
+    with open(os.path.join(static_folder, filename), encoding="utf-8") as page:
+        html = page.read()
+
+    def add_version(match):
+        version = asset_hash(static_folder, match.group(2)[len("static/"):])
+        if not version:
+            return match.group(0)
+        return "{}{}?v={}{}".format(match.group(1), match.group(2), version, match.group(3))
+
+    return ASSET_URL.sub(add_version, html)
@@ -28,11 +28,14 @@ def request_validation_error(error):
     """Handles Value Errors from bad data"""
     message = str(error)
     app.logger.error(message)
-    return {
+    body = {
         "status_code": status.HTTP_400_BAD_REQUEST,
         "error": "Bad Request",
         "message": message,
-    }, status.HTTP_400_BAD_REQUEST
+    }
+    if error.errors:
+        body["errors"] = error.errors
+    return body, status.HTTP_400_BAD_REQUEST
 
 
 '''
@@ -0,0 +1,212 @@
+"""
+Idempotency Keys
+
+Remembers the response to a request that carried an Idempotency-Key header
+so that a client retrying the same request gets the stored response back
+instead of creating the resource a second time.
+
+A key is claimed before the request runs. The database store claims it
+in the request's own transaction, so the claim commits together with the
+request's writes. A retry that arrives while the key is claimed, because
+the first request is still running or stopped after committing, gets a
+409 instead of running again.
+"""
+import json
+import time
+import hashlib
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock
+from flask import abort, current_app, request
+from flask_restx.utils import unpack
+from service.models import db, IdempotencyKey
+from . import status
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+StoredResponse = namedtuple("StoredResponse", "fingerprint status_code body headers")
+
+
+def pending(fingerprint):
+    """Returns the StoredResponse of a claimed key whose request has not finished"""
+    return StoredResponse(fingerprint, None, None, None)
+
+
+class MemoryStore:
+    """Keeps stored responses in process, for tests and single workers"""
+
+    def __init__(self, ttl, capacity=10000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns the StoredResponse for a key or None"""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def claim(self, key, fingerprint):
+        """Reserves a key, returns None or the StoredResponse it already has"""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry:
+                return entry[1]
+            self._entries[key] = (time.monotonic() + self.ttl, pending(fingerprint))
+            return None
+
+    def put(self, key, response):
+        """Stores a StoredResponse under a key"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._evict()
+
+    def release(self, key):
+        """Frees a claimed key whose request did not succeed"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1].status_code is None:
+                del self._entries[key]
+
+    def _evict(self):
+        # entries all share one ttl, so the oldest always expires first
+        now = time.monotonic()
+        while self._entries:
+            expires, _ = next(iter(self._entries.values()))
+            if expires > now and len(self._entries) <= self.capacity:
+                break
+            self._entries.popitem(last=False)
+
+
+class DatabaseStore:
+    """Keeps stored responses in the idempotency_key table, for production"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def get(self, key):
+        """Returns the StoredResponse for a key or None"""
+        record = IdempotencyKey.query.filter(
+            IdempotencyKey.key == key, IdempotencyKey.expires > datetime.utcnow()
+        ).first()
+        if not record:
+            return None
+        if record.status_code == IdempotencyKey.PENDING:
+            return pending(record.fingerprint)
+        response = json.loads(record.response)
+        return StoredResponse(
+            record.fingerprint, record.status_code, response["body"], response["headers"]
+        )
+
+    def claim(self, key, fingerprint):
+        """
+        Reserves a key in the session's transaction, returns None or the
+        StoredResponse it already has
+        """
+        expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+        if IdempotencyKey.claim(key, fingerprint, expires):
+            return None
+        return self.get(key)
+
+    def put(self, key, response):
+        """Stores a StoredResponse under a key"""
+        now = datetime.utcnow()
+        IdempotencyKey.query.filter(IdempotencyKey.expires <= now).delete(
+            synchronize_session=False
+        )
+        db.session.merge(
+            IdempotencyKey(
+                key=key,
+                fingerprint=response.fingerprint,
+                status_code=response.status_code,
+                response=json.dumps({"body": response.body, "headers": response.headers}),
+                expires=now + timedelta(seconds=self.ttl),
+            )
+        )
+        db.session.commit()
+
+    @staticmethod
+    def release(key):
+        """Frees a claimed key whose request did not succeed"""
+        db.session.rollback()
+        IdempotencyKey.query.filter(
+            IdempotencyKey.key == key, IdempotencyKey.status_code == IdempotencyKey.PENDING
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+STORES = {"memory": MemoryStore, "database": DatabaseStore}
+
+
+def get_store():
+    """Returns the idempotency store configured for the current app"""
+    store = current_app.extensions.get("idempotency")
+    if store is None:
+        store_class = STORES[current_app.config.get("IDEMPOTENCY_STORE", "database")]
+        store = store_class(current_app.config.get("IDEMPOTENCY_TTL", 86400))
+        current_app.extensions["idempotency"] = store
+    return store
+
+
+def _digest(*parts):
+    """Returns a compact fixed size digest of the parts"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def idempotent(function):
+    """
+    Decorator that replays the stored response of a successful request
+    when it is retried with the same Idempotency-Key header, and refuses
+    a retry while the key is claimed by a request that has not finished
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            return function(*args, **kwargs)
+        store = get_store()
+        key = _digest(request.method, request.path, idempotency_key)
+        fingerprint = _digest(request.get_data())
+        stored = store.claim(key, fingerprint)
+        if stored:
+            return replay(stored, fingerprint, idempotency_key)
+        try:
+            body, status_code, headers = unpack(function(*args, **kwargs))
+        except Exception:
+            store.release(key)
+            raise
+        if status_code < 300:
+            store.put(key, StoredResponse(fingerprint, status_code, body, dict(headers or {})))
+        else:
+            store.release(key)
+        return body, status_code, headers
+
+    return wrapper
+
+
+def replay(stored, fingerprint, idempotency_key):
+    """Returns the stored response of a key, or aborts when it cannot be replayed"""
+    if stored.fingerprint != fingerprint:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"{IDEMPOTENCY_HEADER} '{idempotency_key}' was used with a different payload",
+        )
+    if stored.status_code is None:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"A request with {IDEMPOTENCY_HEADER} '{idempotency_key}' is still being processed",
+        )
+    current_app.logger.info("Replaying response for %s", idempotency_key)
+    headers = dict(stored.headers, **{REPLAYED_HEADER: "true"})
+    return stored.body, stored.status_code, headers
@@ -0,0 +1,52 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Money
+
+Prices are stored as whole cents, so sums and products of prices are
+exact integer arithmetic. The API keeps showing them as decimal amounts:
+a float made by dividing the cents by 100 is the closest one to that
+amount, so it is written out as exactly that decimal (4.99, not 4.98999).
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+CENT = Decimal("0.01")
+
+
+def to_cents(amount):
+    """
+    Returns an amount of money as whole cents, rounding half cents up
+    Args:
+        amount (int, float, str or Decimal): the amount, 4.99 for example
+    Raises:
+        ValueError: when the amount is not a finite number
+    """
+    if isinstance(amount, bool):
+        raise ValueError("Invalid amount: {!r}".format(amount))
+    try:
+        cents = Decimal(str(amount)).quantize(CENT, rounding=ROUND_HALF_UP) * 100
+    except (InvalidOperation, ValueError) as error:
+        raise ValueError("Invalid amount: {!r}".format(amount)) from error
+    return int(cents)
+
+
+def from_cents(cents):
+    """Returns whole cents as the decimal amount that the API shows"""
+    if cents is None:
+        return None
+    return cents / 100
@@ -0,0 +1,261 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Cart Pricing
+
+Prices shop carts with promotion rules and a tax rate. The lines of one
+cart, or of many carts at once, are held as columns (CartLines) and
+every rule is applied to a whole column in one pass. Matching a rule
+against product names is done once per distinct name, not per line.
+Amounts are whole cents, so every step is exact integer arithmetic.
+
+A rule is a dictionary with a type and, optionally, the product names
+it applies to (every product when left out):
+    {"type": "percent", "percent": 10}            - 10% off the line
+    {"type": "fixed", "amount": 0.50}             - 0.50 off every unit
+    {"type": "bogo", "buy": 2, "get": 1}          - every third unit free
+Rules are applied in order, each to what is left of the line after the
+rules before it, and never take a line below zero. The tax rate is a
+percentage of what is left of the cart.
+
+quote_per_line() prices one line at a time with Decimal arithmetic the
+way a simple loop would. It is the reference the engine is tested and
+benchmarked against.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from service.utils.money import to_cents, from_cents
+
+RULE_TYPES = ("percent", "fixed", "bogo")
+
+# rates are kept as whole parts per million of an amount
+MILLION = 1000000
+HALF = MILLION // 2
+
+
+def parts_per_million(percent, what):
+    """Returns a percentage between 0 and 100 as whole parts per million"""
+    try:
+        ppm = Decimal(str(percent)) * 10000
+    except (InvalidOperation, ValueError) as error:
+        raise ValueError("Invalid {}: {!r}".format(what, percent)) from error
+    if not ppm.is_finite() or ppm != ppm.to_integral_value() or not 0 <= ppm <= MILLION:
+        raise ValueError("Invalid {}: {!r}".format(what, percent))
+    return int(ppm)
+
+
+def _count(data, key, default):
+    value = data.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("Invalid {}: {!r}".format(key, value))
+    return value
+
+
+class Rule:
+    """
+    One promotion rule
+    Args:
+        kind (str): one of RULE_TYPES
+        names (iterable): the product names it applies to, None for all
+        ppm (int): the percentage off in parts per million, for percent
+        amount (int): the cents off every unit, for fixed
+        buy (int): how many units must be bought, for bogo
+        get (int): how many more units are then free, for bogo
+    """
+
+    def __init__(self, kind, names=None, ppm=0, amount=0, buy=1, get=1):
+        self.kind = kind
+        self.names = None if names is None else frozenset(names)
+        self.ppm = ppm
+        self.amount = amount
+        self.buy = buy
+        self.get = get
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns the Rule that a JSON rule describes, raises ValueError when it is not valid"""
+        if not isinstance(data, dict) or data.get("type") not in RULE_TYPES:
+            raise ValueError("Invalid rule: {!r}".format(data))
+        names = data.get("names")
+        if names is not None and (not isinstance(names, list) or not all(isinstance(name, str) for name in names)):
+            raise ValueError("Invalid names: {!r}".format(names))
+        kind = data["type"]
+        if kind == "percent":
+            return cls(kind, names, ppm=parts_per_million(data.get("percent"), "percent"))
+        if kind == "fixed":
+            amount = to_cents(data.get("amount"))
+            if amount < 0:
+                raise ValueError("Invalid amount: {!r}".format(data.get("amount")))
+            return cls(kind, names, amount=amount)
+        return cls(kind, names, buy=_count(data, "buy", 1), get=_count(data, "get", 1))
+
+    def matches(self, names):
+        """Returns a column that is True for the lines the rule applies to"""
+        if self.names is None:
+            return [True] * len(names)
+        matched = {name: name in self.names for name in set(names)}
+        return [matched[name] for name in names]
+
+    def line_discount(self, quantity, price, net):
+        """Returns the cents off one line, for the per-line reference"""
+        if self.kind == "percent":
+            off = (Decimal(net) * self.ppm / MILLION).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+        elif self.kind == "fixed":
+            off = Decimal(quantity) * self.amount
+        else:
+            off = Decimal(quantity // (self.buy + self.get) * self.get) * price
+        return min(Decimal(net), off)
+
+    def apply(self, lines, net):
+        """Returns the net column after taking this rule off every matching line"""
+        mask = self.matches(lines.names)
+        if self.kind == "percent":
+            ppm = self.ppm
+            return [n - (n * ppm + HALF) // MILLION if m else n for n, m in zip(net, mask)]
+        if self.kind == "fixed":
+            amount = self.amount
+            return [n - min(n, q * amount) if m else n for n, q, m in zip(net, lines.quantities, mask)]
+        group, get = self.buy + self.get, self.get
+        return [
+            n - min(n, q // group * get * p) if m else n
+            for n, q, p, m in zip(net, lines.quantities, lines.prices, mask)
+        ]
+
+
+def parse_rules(rules):
+    """Returns the Rules of a JSON list of rules, raises ValueError when one is not valid"""
+    if rules is None:
+        return []
+    if not isinstance(rules, list):
+        raise ValueError("Invalid rules: {!r}".format(rules))
+    return [Rule.from_dict(rule) for rule in rules]
+
+
+class CartLines:
+    """The product lines of one or more shop carts, held as columns"""
+
+    def __init__(self, rows=()):
+        self.shopcart_ids = []
+        self.product_ids = []
+        self.names = []
+        self.quantities = []
+        self.prices = []
+        for row in rows:
+            self.append(*row)
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def append(self, shopcart_id, product_id, name, quantity, price_cents):
+        """Adds one line, its price in whole cents"""
+        self.shopcart_ids.append(shopcart_id)
+        self.product_ids.append(product_id)
+        self.names.append(name)
+        self.quantities.append(quantity)
+        self.prices.append(price_cents)
+
+    def rows(self):
+        """Returns the lines as (shopcart_id, product_id, name, quantity, price_cents) rows"""
+        return list(zip(self.shopcart_ids, self.product_ids, self.names, self.quantities, self.prices))
+
+
+def price_lines(lines, rules):
+    """Returns the gross and the net cents columns of the lines after the rules"""
+    gross = [q * p for q, p in zip(lines.quantities, lines.prices)]
+    net = gross
+    for rule in rules:
+        net = rule.apply(lines, net)
+    return gross, net
+
+
+def quote_carts(shopcart_ids, lines, rules, tax_rate=0, detail=False):
+    """
+    Prices shop carts, returns one quote per cart in the order of shopcart_ids
+    Args:
+        shopcart_ids (list): the carts to quote, a cart without lines costs 0
+        lines (CartLines): the lines of the carts
+        rules (list): the Rules to apply, in order
+        tax_rate (float): the tax as a percentage of the discounted subtotal
+        detail (bool): also return the price of every line
+    """
+    tax_ppm = parts_per_million(tax_rate, "tax rate")
+    gross, net = price_lines(lines, rules)
+    totals = {shopcart_id: [0, 0] for shopcart_id in shopcart_ids}
+    for shopcart_id, line_gross, line_net in zip(lines.shopcart_ids, gross, net):
+        total = totals[shopcart_id]
+        total[0] += line_gross
+        total[1] += line_net
+    quotes = []
+    for shopcart_id in shopcart_ids:
+        subtotal, discounted = totals[shopcart_id]
+        quotes.append(_quote(shopcart_id, subtotal, discounted, (discounted * tax_ppm + HALF) // MILLION))
+    if detail:
+        index = {quote["shopcart_id"]: quote for quote in quotes}
+        for quote in quotes:
+            quote["lines"] = []
+        for i, shopcart_id in enumerate(lines.shopcart_ids):
+            index[shopcart_id]["lines"].append({
+                "product_id": lines.product_ids[i],
+                "name": lines.names[i],
+                "quantity": lines.quantities[i],
+                "price": from_cents(lines.prices[i]),
+                "subtotal": from_cents(gross[i]),
+                "discount": from_cents(gross[i] - net[i]),
+                "total": from_cents(net[i]),
+            })
+    return quotes
+
+
+def quote_per_line(shopcart_ids, rows, rules, tax_rate=0):
+    """
+    Prices shop carts one line at a time with Decimal arithmetic, returns
+    the same quotes as quote_carts() without the line details
+    Args:
+        shopcart_ids (list): the carts to quote
+        rows (list): (shopcart_id, product_id, name, quantity, price_cents) lines
+        rules (list): the Rules to apply, in order
+        tax_rate (float): the tax as a percentage of the discounted subtotal
+    """
+    totals = {shopcart_id: [Decimal(0), Decimal(0)] for shopcart_id in shopcart_ids}
+    for shopcart_id, _, name, quantity, price in rows:
+        line = Decimal(quantity) * price
+        net = line
+        for rule in rules:
+            if rule.names is None or name in rule.names:
+                net -= rule.line_discount(quantity, price, net)
+        totals[shopcart_id][0] += line
+        totals[shopcart_id][1] += net
+    rate = Decimal(str(tax_rate)) / 100
+    return [
+        _quote(
+            shopcart_id,
+            int(totals[shopcart_id][0]),
+            int(totals[shopcart_id][1]),
+            int((totals[shopcart_id][1] * rate).quantize(Decimal(1), rounding=ROUND_HALF_UP)),
+        )
+        for shopcart_id in shopcart_ids
+    ]
+
+
+def _quote(shopcart_id, subtotal, discounted, tax):
+    return {
+        "shopcart_id": shopcart_id,
+        "subtotal": from_cents(subtotal),
+        "discount": from_cents(subtotal - discounted),
+        "tax": from_cents(tax),
+        "total": from_cents(discounted + tax),
+    }
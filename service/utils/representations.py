@@ -0,0 +1,106 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Response Formats
+
+The API answers in JSON unless the Accept header asks for one of the
+compact formats below, which carry exactly the same payloads:
+
+    application/msgpack                       MessagePack
+    application/vnd.shopcart.columnar+json    columnar JSON
+    application/vnd.shopcart.columnar+msgpack columnar MessagePack
+
+The columnar formats turn every list of objects into one object of
+columns, so a cart with 10,000 products sends each key once instead of
+10,000 times:
+
+    [{"id": 1, "name": "apple"}, {"id": 2, "name": "pear"}]
+    {"id": [1, 2], "name": ["apple", "pear"]}
+"""
+import json
+from itertools import chain
+from flask import make_response
+from flask_restx.representations import output_json
+import msgpack
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+COLUMNAR_JSON = "application/vnd.shopcart.columnar+json"
+COLUMNAR_MSGPACK = "application/vnd.shopcart.columnar+msgpack"
+
+
+def init_representations(api):
+    """Registers the response formats, JSON stays the default"""
+    api.representation(JSON)(negotiated(output_json))
+    api.representation(COLUMNAR_JSON)(negotiated(output_columnar_json))
+    api.representation(MSGPACK)(negotiated(output_msgpack))
+    api.representation(COLUMNAR_MSGPACK)(negotiated(output_columnar_msgpack))
+
+
+def negotiated(output):
+    """Marks the responses of a format as depending on the Accept header"""
+    def output_negotiated(data, code, headers=None):
+        response = output(data, code, headers)
+        response.vary.add("Accept")
+        return response
+    return output_negotiated
+
+
+def to_columns(data):
+    """Returns the payload with every list of objects turned into an object of columns"""
+    if isinstance(data, dict):
+        return {key: _nested(value) for key, value in data.items()}
+    if isinstance(data, list) and data and all(isinstance(item, dict) for item in data):
+        keys = dict.fromkeys(chain.from_iterable(data))
+        return {key: [_nested(item.get(key)) for item in data] for key in keys}
+    return data
+
+
+def _nested(value):
+    return to_columns(value) if isinstance(value, (dict, list)) else value
+
+
+def encode_json(data):
+    """Returns the compact JSON encoding of a payload"""
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def encode_msgpack(data):
+    """Returns the MessagePack encoding of a payload"""
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _binary_response(body, code, headers):
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def output_columnar_json(data, code, headers=None):
+    """Makes a Flask response with a columnar JSON body"""
+    return _binary_response(encode_json(to_columns(data)), code, headers)
+
+
+def output_msgpack(data, code, headers=None):
+    """Makes a Flask response with a MessagePack body"""
+    return _binary_response(encode_msgpack(data), code, headers)
+
+
+def output_columnar_msgpack(data, code, headers=None):
+    """Makes a Flask response with a columnar MessagePack body"""
+    return _binary_response(encode_msgpack(to_columns(data)), code, headers)
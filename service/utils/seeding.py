@@ -0,0 +1,106 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Data Generator
+
+Generates realistic looking shop carts for load and performance testing.
+The shape of the data is configurable: how many lines a cart has, how
+many different product names there are and how popular each one is,
+and how the prices are spread. The same seed always generates the same
+data, so a dataset can be rebuilt anywhere.
+"""
+import math
+import random
+from bisect import bisect
+from itertools import accumulate, product
+
+ADJECTIVES = (
+    "red", "green", "fresh", "organic", "large", "small", "sweet", "sour",
+    "frozen", "dried", "sliced", "whole", "ripe", "wild", "golden", "spicy",
+)
+NOUNS = (
+    "apple", "peach", "banana", "pear", "cake", "grape", "melon", "cherry",
+    "plum", "bread", "cheese", "butter", "coffee", "tea", "rice", "pasta",
+    "tomato", "onion", "pepper", "carrot", "lemon", "orange", "cookie", "honey",
+)
+
+
+def product_names(count):
+    """Returns count different product names"""
+    words = [" ".join(pair) for pair in product(ADJECTIVES, NOUNS)]
+    random.Random(0).shuffle(words)
+    names = []
+    for i in range(count):
+        name = words[i % len(words)]
+        if i >= len(words):
+            name = "{} {}".format(name, i // len(words) + 1)
+        names.append(name)
+    return names
+
+
+class CartGenerator:
+    """
+    Generates shop carts and their products
+
+    Args:
+        lines (float): the average number of products in a cart, the
+            number is exponentially distributed so most carts are small
+        max_lines (int): no cart has more products than this
+        names (int): how many different product names there are
+        name_skew (float): the exponent of the Zipf distribution of the
+            names, 0 makes every name equally popular
+        price_median (float): the median price of a product
+        price_sigma (float): the spread of the log-normal price distribution
+        seed (int): the seed of the random numbers
+    """
+
+    def __init__(self, lines=4.0, max_lines=50, names=1000, name_skew=1.0,
+                 price_median=4.99, price_sigma=1.0, seed=0):
+        self.random = random.Random(seed)
+        self.lines = lines
+        self.max_lines = max_lines
+        self.names = product_names(names)
+        self.name_weights = list(accumulate(1 / rank ** name_skew for rank in range(1, names + 1)))
+        # every product name has its own price in cents, so the same product costs the same in every cart
+        self.prices = [
+            max(1, round(self.random.lognormvariate(math.log(price_median), price_sigma) * 100))
+            for _ in self.names
+        ]
+
+    def line_count(self):
+        """Returns the number of products of the next cart"""
+        if self.lines <= 0:
+            return 0
+        return min(self.max_lines, int(self.random.expovariate(1 / self.lines) + 0.5))
+
+    def quantity(self):
+        """Returns a quantity, one is the most common"""
+        return 1 + min(9, int(self.random.expovariate(1.5)))
+
+    def product_rows(self, shopcart_id):
+        """Returns (name, quantity, price_cents, shopcart_id) rows for one cart"""
+        rows = []
+        for _ in range(self.line_count()):
+            index = bisect(self.name_weights, self.random.random() * self.name_weights[-1])
+            index = min(index, len(self.names) - 1)
+            rows.append((self.names[index], self.quantity(), self.prices[index], shopcart_id))
+        return rows
+
+    def carts(self, first_id, count):
+        """Generates (shopcart_id, product rows) for count carts starting at first_id"""
+        for shopcart_id in range(first_id, first_id + count):
+            yield shopcart_id, self.product_rows(shopcart_id)
@@ -0,0 +1,80 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Cart Snapshot Encoding
+
+A snapshot holds the lines of a cart as one compressed blob instead of a
+copy of every product row. The lines are stored as columns in compact
+JSON, which zlib compresses well because every column repeats the same
+kind of values:
+
+    {"v":1,"name":["apple","pear"],"quantity":[2,1],"price_cents":[199,250]}
+
+Lines are (name, quantity, price_cents) tuples.
+"""
+import json
+import zlib
+from collections import OrderedDict
+
+VERSION = 1
+
+
+def encode_lines(lines):
+    """Returns the compressed blob of a list of (name, quantity, price_cents) lines"""
+    columns = {"v": VERSION, "name": [], "quantity": [], "price_cents": []}
+    for name, quantity, price_cents in lines:
+        columns["name"].append(name)
+        columns["quantity"].append(quantity)
+        columns["price_cents"].append(price_cents)
+    return zlib.compress(json.dumps(columns, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def decode_lines(blob):
+    """Returns the (name, quantity, price_cents) lines of a compressed blob"""
+    columns = json.loads(zlib.decompress(blob).decode("utf-8"))
+    if columns.get("v") != VERSION:
+        raise ValueError("Unknown snapshot version: {!r}".format(columns.get("v")))
+    return list(zip(columns["name"], columns["quantity"], columns["price_cents"]))
+
+
+def by_name(lines):
+    """Returns the lines keyed by name, adding up the quantities of repeated names"""
+    merged = OrderedDict()
+    for name, quantity, price_cents in lines:
+        if name in merged:
+            merged[name] = (merged[name][0] + quantity, merged[name][1])
+        else:
+            merged[name] = (quantity, price_cents)
+    return merged
+
+
+def diff_lines(old, new):
+    """
+    Compares two lists of lines by product name
+    Returns:
+        a dict of the added and removed (name, quantity, price_cents) lines
+        and of the changed names with their old and new quantity and price
+    """
+    old, new = by_name(old), by_name(new)
+    return {
+        "added": [(name,) + new[name] for name in new if name not in old],
+        "removed": [(name,) + old[name] for name in old if name not in new],
+        "changed": [
+            (name, old[name], new[name]) for name in new if name in old and old[name] != new[name]
+        ],
+    }
@@ -0,0 +1,213 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cart Import and Export
+
+Moves shop carts between databases as a stream of carts in shopcart id
+order, so neither side ever holds more than one batch in memory.
+
+Two formats are supported:
+    ndjson - one JSON object per cart with its products
+    csv    - one row per product with the columns of CSV_COLUMNS, a cart
+             without products is one row with empty product columns
+
+An import commits every batch of carts and records the id of the last
+committed cart in a checkpoint file. Running it again with the same
+checkpoint skips the carts that are already in.
+"""
+import csv
+import json
+import os
+from datetime import datetime
+from itertools import groupby
+from sqlalchemy import select
+from service.models import db, Shopcart, Product
+from service.utils.bulk import copy_rows, chunks
+from service.utils.money import to_cents, from_cents
+
+FORMATS = ("csv", "ndjson")
+CSV_COLUMNS = ["shopcart_id", "updated_at", "product_id", "name", "quantity", "price"]
+PRODUCT_COLUMNS = ["id", "name", "quantity", "price_cents", "shopcart_id"]
+
+
+def guess_format(path):
+    """Returns the format that the extension of a file name implies"""
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+######################################################################
+#  E X P O R T
+######################################################################
+def read_carts(connection, batch):
+    """Generates (id, updated_at, products) for every cart, batch carts per query"""
+    shopcart, product = Shopcart.__table__, Product.__table__
+    last_id = None
+    while True:
+        query = select([shopcart.c.id, shopcart.c.updated_at]).order_by(shopcart.c.id).limit(batch)
+        if last_id is not None:
+            query = query.where(shopcart.c.id > last_id)
+        carts = connection.execute(query).fetchall()
+        if not carts:
+            return
+        rows = connection.execute(
+            select([product.c[column] for column in PRODUCT_COLUMNS])
+            .where(product.c.shopcart_id.between(carts[0].id, carts[-1].id))
+            .order_by(product.c.shopcart_id, product.c.id)
+        ).fetchall()
+        products = {key: list(group) for key, group in groupby(rows, lambda row: row.shopcart_id)}
+        for cart in carts:
+            yield cart.id, cart.updated_at, products.get(cart.id, [])
+        last_id = carts[-1].id
+
+
+def write_carts(carts, out, fmt):
+    """Writes (id, updated_at, products) carts to a text file, returns the count"""
+    writer = csv.writer(out, lineterminator="\n") if fmt == "csv" else None
+    if writer:
+        writer.writerow(CSV_COLUMNS)
+    count = 0
+    for shopcart_id, updated_at, products in carts:
+        if writer:
+            for row in products or [None]:
+                writer.writerow(
+                    [shopcart_id, updated_at.isoformat()]
+                    + ([row.id, row.name, row.quantity, from_cents(row.price_cents)] if row else [None] * 4)
+                )
+        else:
+            record = {
+                "id": shopcart_id,
+                "updated_at": updated_at.isoformat(),
+                "products": [
+                    {"id": row.id, "name": row.name, "quantity": row.quantity, "price": from_cents(row.price_cents)}
+                    for row in products
+                ],
+            }
+            out.write(json.dumps(record, separators=(",", ":")) + "\n")
+        count += 1
+    return count
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+def parse_carts(lines, fmt):
+    """Generates (id, updated_at, product rows) carts from the lines of a file"""
+    if fmt == "ndjson":
+        for line in lines:
+            if line.strip():
+                yield cart_from_record(json.loads(line))
+        return
+    rows = csv.DictReader(lines)
+    for shopcart_id, group in groupby(rows, lambda row: int(row["shopcart_id"])):
+        group = list(group)
+        yield shopcart_id, datetime.fromisoformat(group[0]["updated_at"]), [
+            (int(row["product_id"]), row["name"], int(row["quantity"]), to_cents(row["price"]), shopcart_id)
+            for row in group
+            if row["product_id"]
+        ]
+
+
+def cart_from_record(record):
+    """
+    Returns the (id, updated_at, product rows) cart of an exported JSON
+    record, updated_at may be left out
+    """
+    updated_at = record.get("updated_at")
+    updated_at = datetime.fromisoformat(updated_at) if updated_at else datetime.utcnow()
+    return record["id"], updated_at, [
+        (item["id"], item["name"], item["quantity"], to_cents(item["price"]), record["id"])
+        for item in record.get("products", [])
+    ]
+
+
+def read_checkpoint(path):
+    """Returns the id of the last imported cart in a checkpoint file, or None"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as checkpoint:
+        return json.load(checkpoint)["last_id"]
+
+
+def write_checkpoint(path, last_id):
+    """Records the id of the last imported cart, replacing the file atomically"""
+    if path:
+        with open(path + ".tmp", "w", encoding="utf-8") as checkpoint:
+            json.dump({"last_id": last_id}, checkpoint)
+        os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(path):
+    """Deletes a checkpoint file once there is nothing left to resume"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def import_carts(carts, batch, checkpoint=None, progress=None):
+    """
+    Loads (id, updated_at, product rows) carts, committing every batch
+    Args:
+        carts (iterable): the carts in shopcart id order
+        batch (int): the number of carts to commit at once
+        checkpoint (str): the file that records the last committed cart,
+            deleted when the whole import has committed
+        progress (callable): called with the cart and product totals
+    Returns:
+        the number of carts and products that were loaded
+    """
+    last_id = read_checkpoint(checkpoint)
+    if last_id is not None:
+        carts = (cart for cart in carts if cart[0] > last_id)
+    loaded_carts = loaded_products = 0
+    for chunk in chunks(carts, batch):
+        with db.engine.begin() as connection:
+            counts = load_carts(connection, chunk)
+        loaded_carts += counts[0]
+        loaded_products += counts[1]
+        write_checkpoint(checkpoint, chunk[-1][0])
+        if progress:
+            progress(loaded_carts, loaded_products)
+    if loaded_products:
+        with db.engine.begin() as connection:
+            reset_product_sequence(connection)
+    # a later import of the same file, e.g. into another database, starts over
+    remove_checkpoint(checkpoint)
+    return loaded_carts, loaded_products
+
+
+def load_carts(connection, carts):
+    """Loads a list of (id, updated_at, product rows) carts, returns the counts"""
+    return (
+        copy_rows(connection, Shopcart.__table__, ["id", "updated_at"], ((cart[0], cart[1]) for cart in carts)),
+        copy_rows(connection, Product.__table__, PRODUCT_COLUMNS, (row for cart in carts for row in cart[2])),
+    )
+
+
+def reset_product_sequence(connection):
+    """Moves the product id sequence past ids that were not taken from it"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            "SELECT setval(pg_get_serial_sequence('product', 'id'), coalesce((SELECT max(id) FROM product), 0) + 1, false)"
+        )
+
+
+def truncate_carts(connection):
+    """Deletes every product and shop cart"""
+    if connection.dialect.name == "postgresql":
+        connection.execute("TRUNCATE product, shopcart")
+    else:
+        connection.execute(Product.__table__.delete())
+        connection.execute(Shopcart.__table__.delete())
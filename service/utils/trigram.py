@@ -0,0 +1,63 @@
+"""
+Trigram Index
+
+A small in-memory trigram index that scores names the same way as the
+Postgres pg_trgm extension. It is used for fuzzy product name search on
+SQLite, which cannot do it itself. Postgres needs pg_trgm for fuzzy search
+"""
+import re
+from collections import defaultdict
+
+WORD = re.compile(r"[^\W_]+")
+
+# pg_trgm's default similarity threshold
+SIMILARITY_THRESHOLD = 0.3
+
+
+def trigrams(text):
+    """Returns the set of trigrams of a text, like pg_trgm's show_trgm()"""
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Inverted index from trigrams to the names that contain them"""
+
+    def __init__(self, names=()):
+        self._postings = defaultdict(set)
+        self._trigrams = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._trigrams)
+
+    def add(self, name):
+        """Adds a name to the index"""
+        if name in self._trigrams:
+            return
+        grams = trigrams(name)
+        self._trigrams[name] = grams
+        for gram in grams:
+            self._postings[gram].add(name)
+
+    def search(self, term, threshold=SIMILARITY_THRESHOLD):
+        """
+        Returns (name, similarity) pairs for the names similar to the term,
+        most similar first
+        """
+        term_grams = trigrams(term)
+        shared = defaultdict(int)
+        for gram in term_grams:
+            for name in self._postings.get(gram, ()):
+                shared[name] += 1
+        matches = []
+        for name, common in shared.items():
+            similarity = common / (len(term_grams) + len(self._trigrams[name]) - common)
+            if similarity >= threshold:
+                matches.append((name, similarity))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches
@@ -0,0 +1,177 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Request Validation
+
+Compiles an api.model into a Validator once, at import. A Validator
+checks a request body and converts it to the values the models expect in
+a single pass, and reports every problem it finds at once. Numbers may be
+sent as strings, the way HTML forms send them:
+
+    {"name": "is required", "price": "must be a number"}
+
+Read only fields are never required, but are checked when they are sent,
+e.g. the ids that match the products of a shop cart PUT to the stored
+ones. Fields named as optional, at any depth, may be left out or null
+even when the model requires them, e.g. the shop cart id of a product
+whose shop cart is given by the URL.
+"""
+import math
+from flask_restx import fields
+from service.models import DataValidationError
+
+
+class Invalid(ValueError):
+    """Raised by a compiled field when its value is not valid"""
+
+
+class Validator:
+    """Checks and converts request bodies against an api.model"""
+
+    def __init__(self, model, optional=()):
+        self.name = model.name
+        self.fields = [
+            (name, compile_field(field, optional), bool(field.required) and not field.readonly and name not in optional)
+            for name, field in model.items()
+        ]
+
+    def __call__(self, data):
+        """
+        Returns the converted fields of a request body
+        Raises:
+            DataValidationError: with the errors of every field that is not valid
+        """
+        errors = {}
+        result = self.convert(data, errors, "")
+        if errors:
+            raise DataValidationError("Invalid {}: {}".format(self.name, "; ".join(
+                "{} {}".format(path, message) if path else message for path, message in errors.items()
+            )), errors)
+        return result
+
+    def convert(self, data, errors, prefix):
+        """Converts an object, collecting the problems in errors by field path"""
+        if not isinstance(data, dict):
+            errors[prefix.rstrip(".") or "body"] = "must be an object"
+            return None
+        result = {}
+        for name, convert, required in self.fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    errors[prefix + name] = "is required"
+                result[name] = None
+                continue
+            try:
+                result[name] = convert(value, errors, prefix + name)
+            except Invalid as error:
+                errors[prefix + name] = str(error)
+        return result
+
+
+def compile_field(field, optional=()):
+    """Returns a function that converts the values of one api.model field"""
+    if isinstance(field, fields.Nested):
+        validator = Validator(field.nested, optional)
+        return lambda value, errors, path: validator.convert(value, errors, path + ".")
+    if isinstance(field, fields.List):
+        return compile_list(compile_field(field.container, optional))
+    if isinstance(field, fields.Integer):
+        return compile_number(field, to_integer)
+    if isinstance(field, fields.Float):
+        return compile_number(field, to_float)
+    if isinstance(field, fields.String):
+        return compile_string(field)
+    if isinstance(field, fields.Boolean):
+        return compile_type(bool, "must be true or false")
+    return lambda value, errors, path: value
+
+
+def compile_list(convert_item):
+    """Returns a function that converts a list, each item with convert_item"""
+    def convert(value, errors, path):
+        if not isinstance(value, list):
+            raise Invalid("must be a list")
+        return [convert_item(item, errors, "{}[{}]".format(path, i)) for i, item in enumerate(value)]
+    return convert
+
+
+def compile_type(kind, message):
+    """Returns a function that accepts only values of one Python type"""
+    def convert(value, errors, path):
+        if not isinstance(value, kind):
+            raise Invalid(message)
+        return value
+    return convert
+
+
+def compile_string(field):
+    """Returns a function that checks a string against the field's length limits"""
+    min_length, max_length = field.min_length or 0, field.max_length
+
+    def convert(value, errors, path):
+        if not isinstance(value, str):
+            raise Invalid("must be a string")
+        if len(value) < min_length:
+            raise Invalid("must be at least {} characters".format(min_length))
+        if max_length is not None and len(value) > max_length:
+            raise Invalid("must be at most {} characters".format(max_length))
+        return value
+    return convert
+
+
+def compile_number(field, to_number):
+    """Returns a function that converts a number with to_number and checks the field's range"""
+    minimum, maximum = field.minimum, field.maximum
+
+    def convert(value, errors, path):
+        number = to_number(value)
+        if minimum is not None and number < minimum:
+            raise Invalid("must be at least {}".format(minimum))
+        if maximum is not None and number > maximum:
+            raise Invalid("must be at most {}".format(maximum))
+        return number
+    return convert
+
+
+def to_integer(value):
+    """Returns a value as an int, whole floats such as 2.0 and digit strings included"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            raise Invalid("must be an integer") from None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise Invalid("must be an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise Invalid("must be an integer")
+        return int(value)
+    return value
+
+
+def to_float(value):
+    """Returns a value as a finite number, numeric strings included"""
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            raise Invalid("must be a number") from None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise Invalid("must be a number")
+    return value
@@ -0,0 +1,123 @@
+"""
+Test database isolation
+
+Every test runner worker gets a database of its own, so the test suite
+can run in parallel (nosetests --processes=N or pytest -n N), and every
+test runs inside a transaction that is rolled back afterwards, so the
+tests do not have to clean up the tables themselves.
+"""
+import multiprocessing
+import os
+import re
+from unittest import TestCase
+from sqlalchemy import create_engine, event
+from service.models import db, RoutingSession
+
+
+def worker_id():
+    """Returns the name of this test worker, or None in a serial run"""
+    worker = os.getenv("PYTEST_XDIST_WORKER")
+    if worker:
+        return worker
+    process = multiprocessing.current_process()
+    if process.name == "MainProcess":
+        return None
+    return re.sub(r"\W", "", process.name).lower()
+
+
+def worker_database_uri(uri):
+    """
+    Returns the database URI for this test worker: a schema of its own on
+    Postgres, or a file of its own for a SQLite file database
+    """
+    worker = worker_id()
+    if worker is None or uri in ("sqlite://", "sqlite:///:memory:"):
+        return uri
+    if uri.startswith("sqlite:///"):
+        root, ext = os.path.splitext(uri)
+        return "{}_{}{}".format(root, worker, ext)
+    schema = "test_" + worker
+    engine = create_engine(uri)
+    try:
+        engine.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+    finally:
+        engine.dispose()
+    return "{}{}options=-csearch_path%3D{}".format(uri, "&" if "?" in uri else "?", schema)
+
+
+def commits(test):
+    """
+    Marks a test whose changes must really be committed, because another
+    connection has to see them. The tables are emptied after it instead.
+    """
+    test.commits = True
+    return test
+
+
+class DatabaseTestCase(TestCase):
+    """Runs every test in a transaction that is rolled back when it ends"""
+
+    # let nosetests --processes share out the tests of one class
+    _multiprocess_can_split_ = True
+
+    @staticmethod
+    def clear_tables():
+        """Deletes the rows of every table"""
+        db.session.remove()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+    def setUp(self):
+        """Binds the session to a connection whose transaction is rolled back"""
+        self.connection = None
+        if getattr(getattr(self, self._testMethodName), "commits", False):
+            return
+        db.session.remove()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        if self.connection.dialect.name == "sqlite":
+            # pysqlite only begins before DML, and releasing a savepoint
+            # outside of a transaction would commit it
+            self.connection.execute("BEGIN")
+        # every session transaction runs in a savepoint of its own, which
+        # is released when it commits and rolled back when it does not
+        self.savepoint = self.connection.begin_nested()
+        self.committed = False
+        event.listen(RoutingSession, "after_commit", self.session_committed)
+        event.listen(RoutingSession, "after_transaction_end", self.restart_savepoint)
+        db.session.configure(bind=self.connection, binds={})
+
+    def session_committed(self, session):
+        """Remembers that the session committed its transaction"""
+        if session.transaction.parent is None:
+            self.committed = True
+
+    def restart_savepoint(self, session, transaction):
+        """Ends the savepoint of a session transaction the way it ended"""
+        if transaction.parent is not None:
+            return
+        if self.savepoint.is_active:
+            if self.committed:
+                self.savepoint.commit()
+            else:
+                self.savepoint.rollback()
+        self.committed = False
+        self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        """Rolls back everything the test did"""
+        if self.connection is None:
+            self.clear_tables()
+            return
+        event.remove(RoutingSession, "after_commit", self.session_committed)
+        event.remove(RoutingSession, "after_transaction_end", self.restart_savepoint)
+        # end the savepoint and then the outer transaction before the session
+        # lets go of the connection, so the pool gets it back with nothing open
+        if self.savepoint.is_active:
+            self.savepoint.rollback()
+        self.transaction.rollback()
+        self.connection.close()
+        db.session.remove()
+        db.session.session_factory.kw.pop("bind", None)
+        db.session.session_factory.kw.pop("binds", None)
@@ -0,0 +1,39 @@
+"""
+Test cases for the change Broadcaster
+
+"""
+import unittest
+
+from service.utils.broadcast import Broadcaster, RESYNC
+
+
+class TestBroadcaster(unittest.TestCase):
+    """Test Cases for Broadcaster"""
+
+    def test_publish(self):
+        """It should deliver a message to every subscriber of its channel only"""
+        broadcaster = Broadcaster()
+        first = broadcaster.subscribe(1)
+        second = broadcaster.subscribe(1)
+        other = broadcaster.subscribe(2)
+        broadcaster.publish(1, "hello")
+        self.assertEqual(first.get(timeout=0), "hello")
+        self.assertEqual(second.get(timeout=0), "hello")
+        self.assertIsNone(other.get(timeout=0))
+        self.assertEqual(broadcaster.subscribers(1), 2)
+        with first, second, other:
+            pass
+        self.assertEqual(broadcaster.subscribers(1), 0)
+        broadcaster.publish(1, "nobody")
+        self.assertIsNone(first.get(timeout=0))
+
+    def test_slow_subscriber(self):
+        """It should replace the messages of a full queue with a resync"""
+        broadcaster = Broadcaster()
+        slow = broadcaster.subscribe(1, maxsize=2)
+        fast = broadcaster.subscribe(1, maxsize=10)
+        for message in range(3):
+            broadcaster.publish(1, message)
+        self.assertIs(slow.get(timeout=0), RESYNC)
+        self.assertIsNone(slow.get(timeout=0))
+        self.assertEqual([fast.get(timeout=0) for _ in range(3)], [0, 1, 2])
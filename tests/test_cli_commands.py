@@ -1,7 +1,9 @@
+from datetime import datetime
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.utils.cli_commands import create_db
+from service import app
+from service.utils.cli_commands import create_db, purge_events, bench_pricing, bench_formats, bench_validation
 
 
 class TestFlaskCLI(TestCase):
@@ -10,9 +12,64 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch("service.utils.cli_commands.create_tables")
     @patch("service.utils.cli_commands.db")
-    def test_create_db(self, db_mock):
+    def test_create_db(self, db_mock, create_tables_mock):
         """It should call the create-db command"""
         db_mock.return_value = MagicMock()
-        result = self.runner.invoke(create_db)
+        with patch.dict(app.config, PRODUCT_PARTITIONS=0):
+            result = self.runner.invoke(create_db)
         self.assertEqual(result.exit_code, 0)
+        create_tables_mock.assert_called_once_with(0)
+
+    @patch("service.utils.cli_commands.create_tables")
+    @patch("service.utils.cli_commands.db")
+    def test_create_db_configured_partitions(self, db_mock, create_tables_mock):
+        """It should partition the product table as configured by default"""
+        db_mock.return_value = MagicMock()
+        with patch.dict(app.config, PRODUCT_PARTITIONS=4):
+            result = self.runner.invoke(create_db)
+        self.assertEqual(result.exit_code, 0)
+        create_tables_mock.assert_called_once_with(4)
+
+    @patch("service.utils.cli_commands.create_tables")
+    @patch("service.utils.cli_commands.db")
+    def test_create_db_partitioned(self, db_mock, create_tables_mock):
+        """It should pass the partition count to create-db"""
+        db_mock.return_value = MagicMock()
+        result = self.runner.invoke(create_db, ["--partitions", "8"])
+        self.assertEqual(result.exit_code, 0)
+        create_tables_mock.assert_called_once_with(8)
+
+    @patch("service.utils.cli_commands.CartEvent")
+    def test_purge_events(self, cart_event_mock):
+        """It should purge the events older than the retention period"""
+        cart_event_mock.purge.return_value = 3
+        result = self.runner.invoke(purge_events, ["--days", "2"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Purged 3 events", result.output)
+        before = cart_event_mock.purge.call_args[0][0]
+        self.assertAlmostEqual((datetime.utcnow() - before).total_seconds(), 2 * 86400, delta=60)
+
+    def test_bench_pricing(self):
+        """It should time the pricing engine against the per-line loop"""
+        result = self.runner.invoke(bench_pricing, ["--carts", "50", "--rounds", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("per-line loop", result.output)
+        self.assertIn("speedup", result.output)
+        result = self.runner.invoke(bench_pricing, ["--carts", "5", "--rules", '[{"type": "free"}]'])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_bench_formats(self):
+        """It should time every response format"""
+        result = self.runner.invoke(bench_formats, ["--lines", "100", "--rounds", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("columnar msgpack", result.output)
+        self.assertIn("bytes", result.output)
+
+    def test_bench_validation(self):
+        """It should time the compiled validators against reqparse"""
+        result = self.runner.invoke(bench_validation, ["--requests", "10", "--lines", "3", "--rounds", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("reqparse", result.output)
+        self.assertIn("compiled", result.output)
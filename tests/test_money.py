@@ -0,0 +1,29 @@
+"""
+Test cases for the Money helpers
+
+"""
+import unittest
+from decimal import Decimal
+
+from service.utils.money import to_cents, from_cents
+
+
+class TestMoney(unittest.TestCase):
+    """Test Cases for whole cent prices"""
+
+    def test_to_cents(self):
+        """It should turn decimal amounts into whole cents"""
+        self.assertEqual(to_cents(4.99), 499)
+        self.assertEqual(to_cents(0.29), 29)
+        self.assertEqual(to_cents("1.005"), 101)
+        self.assertEqual(to_cents(Decimal("-2.5")), -250)
+        self.assertEqual(to_cents(123), 12300)
+        for amount in (None, "abc", float("nan"), float("inf"), True):
+            self.assertRaises(ValueError, to_cents, amount)
+
+    def test_from_cents(self):
+        """It should show whole cents as the same decimal amount"""
+        self.assertEqual(from_cents(499), 4.99)
+        self.assertEqual(repr(from_cents(1234567)), "12345.67")
+        self.assertIsNone(from_cents(None))
+        self.assertEqual(sum(to_cents(0.1) for _ in range(10)), 100)
@@ -0,0 +1,82 @@
+"""
+Test cases for the Cart Pricing engine
+
+"""
+import unittest
+
+from service.utils.pricing import CartLines, Rule, parse_rules, quote_carts, quote_per_line
+from service.utils.seeding import CartGenerator
+
+LINES = [
+    (1, 10, "apple", 3, 199),
+    (1, 11, "pear", 1, 250),
+    (2, 12, "apple", 7, 199),
+]
+
+
+class TestPricing(unittest.TestCase):
+    """Test Cases for quote_carts"""
+
+    def test_no_rules(self):
+        """It should quote the plain subtotals with tax"""
+        quotes = quote_carts([1, 2, 3], CartLines(LINES), [], tax_rate=10)
+        self.assertEqual(
+            quotes[0], {"shopcart_id": 1, "subtotal": 8.47, "discount": 0.0, "tax": 0.85, "total": 9.32}
+        )
+        self.assertEqual(quotes[1]["total"], 15.32)
+        self.assertEqual(quotes[2], {"shopcart_id": 3, "subtotal": 0.0, "discount": 0.0, "tax": 0.0, "total": 0.0})
+
+    def test_rules(self):
+        """It should apply percent, fixed and bogo rules in order"""
+        rules = parse_rules([
+            {"type": "bogo", "buy": 2, "get": 1, "names": ["apple"]},
+            {"type": "percent", "percent": 12.5},
+            {"type": "fixed", "amount": 3, "names": ["pear"]},
+        ])
+        quote = quote_carts([1], CartLines(LINES[:2]), rules, detail=True)[0]
+        # apple: 5.97 - 1.99 free = 3.98, less 12.5% = 3.48; pear: 2.50 less 12.5% = 2.19, less 3 is 0
+        self.assertEqual([line["total"] for line in quote["lines"]], [3.48, 0.0])
+        self.assertEqual([line["discount"] for line in quote["lines"]], [2.49, 2.5])
+        self.assertEqual((quote["subtotal"], quote["discount"], quote["total"]), (8.47, 4.99, 3.48))
+
+    def test_same_as_per_line_loop(self):
+        """It should quote exactly what the per-line loop quotes"""
+        generator = CartGenerator(lines=6, names=40, seed=3)
+        rows = [
+            (shopcart_id, i, name, quantity, price)
+            for i, (name, quantity, price, shopcart_id) in enumerate(
+                row for _, rows in generator.carts(1, 300) for row in rows
+            )
+        ]
+        rules = parse_rules([
+            {"type": "percent", "percent": 7.5, "names": generator.names[:10]},
+            {"type": "bogo", "buy": 1, "get": 1, "names": generator.names[5:15]},
+            {"type": "fixed", "amount": 0.33},
+            {"type": "percent", "percent": 3},
+        ])
+        ids = list(range(1, 302))
+        self.assertEqual(
+            quote_carts(ids, CartLines(rows), rules, 8.875), quote_per_line(ids, rows, rules, 8.875)
+        )
+
+    def test_invalid_rules(self):
+        """It should reject rules that are not valid"""
+        for rules in (
+            {"type": "percent"},
+            [{"type": "free"}],
+            [{"type": "percent", "percent": 101}],
+            [{"type": "percent", "percent": 0.00001}],
+            [{"type": "fixed", "amount": -1}],
+            [{"type": "bogo", "buy": 0}],
+            [{"type": "bogo", "get": True}],
+            [{"type": "fixed", "amount": 1, "names": "apple"}],
+        ):
+            self.assertRaises(ValueError, parse_rules, rules)
+        self.assertEqual(parse_rules(None), [])
+        self.assertRaises(ValueError, quote_carts, [1], CartLines(), [], "abc")
+
+    def test_matches(self):
+        """It should match rules to the lines by product name"""
+        self.assertEqual(Rule("percent", ["pear"]).matches(["apple", "pear", "pear"]), [False, True, True])
+        self.assertEqual(Rule("percent").matches(["apple", "pear"]), [True, True])
+        self.assertEqual(CartLines(LINES).rows(), LINES)
@@ -0,0 +1,45 @@
+"""
+Test cases for the response formats
+
+"""
+import json
+import unittest
+
+import msgpack
+
+from service.utils.representations import to_columns, encode_json, encode_msgpack
+
+PRODUCTS = [
+    {"id": 1, "name": "apple", "price": 1.99, "quantity": 2},
+    {"id": 2, "name": "pear", "price": 2.5, "quantity": 1},
+]
+
+
+class TestRepresentations(unittest.TestCase):
+    """Test Cases for the response encoders"""
+
+    def test_to_columns(self):
+        """It should turn lists of objects into objects of columns"""
+        self.assertEqual(
+            to_columns({"id": 7, "products": PRODUCTS}),
+            {
+                "id": 7,
+                "products": {
+                    "id": [1, 2],
+                    "name": ["apple", "pear"],
+                    "price": [1.99, 2.5],
+                    "quantity": [2, 1],
+                },
+            },
+        )
+        self.assertEqual(to_columns([{"id": 7, "products": []}]), {"id": [7], "products": [[]]})
+        self.assertEqual(to_columns([{"a": 1}, {"b": 2}]), {"a": [1, None], "b": [None, 2]})
+        self.assertEqual(to_columns([1, 2]), [1, 2])
+        self.assertEqual(to_columns("apple"), "apple")
+
+    def test_encoders(self):
+        """It should encode the same payload in every format"""
+        payload = {"id": 7, "products": PRODUCTS}
+        self.assertEqual(json.loads(encode_json(payload)), payload)
+        self.assertEqual(msgpack.unpackb(encode_msgpack(payload)), payload)
+        self.assertNotIn(b" ", encode_json({"a": [1, 2]}))
@@ -0,0 +1,45 @@
+"""
+Test cases for the Cart Snapshot encoding
+
+"""
+import json
+import unittest
+import zlib
+
+from service.utils.snapshot import encode_lines, decode_lines, diff_lines
+
+LINES = [("apple", 2, 199), ("pear", 1, 250), ("apple", 1, 199)]
+
+
+class TestSnapshotEncoding(unittest.TestCase):
+    """Test Cases for encode_lines and decode_lines"""
+
+    def test_round_trip(self):
+        """It should decode the lines it encoded"""
+        blob = encode_lines(LINES)
+        self.assertEqual(decode_lines(blob), LINES)
+        self.assertEqual(decode_lines(encode_lines([])), [])
+        self.assertEqual(json.loads(zlib.decompress(blob))["name"], ["apple", "pear", "apple"])
+
+    def test_compact(self):
+        """It should store many lines in a small blob"""
+        lines = [("organic coffee {}".format(i % 20), 1 + i % 3, 499) for i in range(500)]
+        self.assertLess(len(encode_lines(lines)), 1000)
+
+    def test_unknown_version(self):
+        """It should refuse blobs of an unknown version"""
+        blob = zlib.compress(b'{"v":2}')
+        self.assertRaises(ValueError, decode_lines, blob)
+
+    def test_diff(self):
+        """It should compare lines by name"""
+        new = [("apple", 3, 179), ("kiwi", 1, 50)]
+        self.assertEqual(
+            diff_lines(LINES, new),
+            {
+                "added": [("kiwi", 1, 50)],
+                "removed": [("pear", 1, 250)],
+                "changed": [("apple", (3, 199), (3, 179))],
+            },
+        )
+        self.assertEqual(diff_lines(LINES, LINES), {"added": [], "removed": [], "changed": []})
@@ -0,0 +1,26 @@
+"""
+Test cases for the in-memory Trigram Index
+
+"""
+import unittest
+
+from service.utils.trigram import TrigramIndex, trigrams
+
+
+class TestTrigramIndex(unittest.TestCase):
+    """Test Cases for TrigramIndex"""
+
+    def test_trigrams(self):
+        """It should split words into padded trigrams like pg_trgm"""
+        self.assertEqual(trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(trigrams("a-b"), {"  a", " a ", "  b", " b "})
+        self.assertEqual(trigrams(""), set())
+
+    def test_search(self):
+        """It should rank similar names first and drop dissimilar ones"""
+        index = TrigramIndex(["apple", "apples", "Apple Pie", "banana", "apple"])
+        self.assertEqual(len(index), 4)
+        matches = index.search("apple")
+        self.assertEqual(matches[0], ("apple", 1.0))
+        self.assertEqual([name for name, _ in matches], ["apple", "apples", "Apple Pie"])
+        self.assertEqual(index.search("kiwi"), [])
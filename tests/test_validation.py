@@ -0,0 +1,73 @@
+"""
+Test cases for the compiled request validators
+
+"""
+import unittest
+
+from flask_restx import Model, fields
+
+from service.models import DataValidationError
+from service.utils.validation import Validator
+
+LINE = Model("Line", {
+    "id": fields.Integer(readonly=True),
+    "name": fields.String(required=True, max_length=8),
+    "quantity": fields.Integer(required=True, min=0),
+    "price": fields.Float(required=True),
+    "cart_id": fields.Integer(required=True),
+    "gift": fields.Boolean(),
+})
+CART = Model("Cart", {
+    "id": fields.Integer(required=True),
+    "lines": fields.List(fields.Nested(LINE), required=True),
+})
+
+
+class TestValidator(unittest.TestCase):
+    """Test Cases for Validator"""
+
+    def errors(self, validator, data):
+        with self.assertRaises(DataValidationError) as context:
+            validator(data)
+        return context.exception.errors
+
+    def test_convert(self):
+        """It should convert a valid body and leave out unknown fields"""
+        validator = Validator(LINE)
+        self.assertEqual(
+            validator({"id": "9", "name": "apple", "quantity": 2.0, "price": "1.99", "cart_id": "3", "other": 1}),
+            {"id": 9, "name": "apple", "quantity": 2, "price": 1.99, "cart_id": 3, "gift": None},
+        )
+        # read only fields are never required
+        self.assertIsNone(validator({"name": "apple", "quantity": 1, "price": 1, "cart_id": 3})["id"])
+
+    def test_errors(self):
+        """It should report every invalid field at once"""
+        errors = self.errors(Validator(LINE), {"name": "pineapples", "quantity": -1, "price": "cheap", "gift": "yes"})
+        self.assertEqual(errors, {
+            "name": "must be at most 8 characters",
+            "quantity": "must be at least 0",
+            "price": "must be a number",
+            "cart_id": "is required",
+            "gift": "must be true or false",
+        })
+        self.assertEqual(self.errors(Validator(LINE), ["apple"]), {"body": "must be an object"})
+        for value in (True, 1.5, "two", float("nan")):
+            self.assertIn("quantity", self.errors(Validator(LINE), {"quantity": value}))
+        self.assertIn("price", self.errors(Validator(LINE), {"price": float("inf")}))
+
+    def test_nested(self):
+        """It should check nested lists of objects and name the failing paths"""
+        validator = Validator(CART, optional=("cart_id",))
+        line = {"name": "apple", "quantity": 1, "price": 1}
+        self.assertEqual(validator({"id": 1, "lines": [line]})["lines"][0]["cart_id"], None)
+        errors = self.errors(validator, {"id": "x", "lines": [line, dict(line, price=None), 7]})
+        self.assertEqual(errors, {
+            "id": "must be an integer",
+            "lines[1].price": "is required",
+            "lines[2]": "must be an object",
+        })
+        self.assertEqual(self.errors(validator, {"id": 1, "lines": {}}), {"lines": "must be a list"})
+        with self.assertRaises(DataValidationError) as context:
+            validator({"id": 1, "lines": [7]})
+        self.assertEqual(str(context.exception), "Invalid Cart: lines[0] must be an object")